@@ -10,3 +10,4 @@ UI.
 from .reportcore import *  # noqa: F401
 from .client import *  # noqa: F401
 from .serialization import *  # noqa: F401
+from .binary import *  # noqa: F401
@@ -0,0 +1,248 @@
+"""
+A binary encoding of tab2 tables.  Each column is sent as a typed buffer
+which the client reads through a memoryview rather than parsing a JSON
+string per value.
+
+The layout is the magic bytes, a little-endian uint32 header length, a JSON
+header and the column buffers.  Each buffer starts on an 8 byte boundary
+relative to the start of the data.  The header holds the non-table keys and
+for each table its columns, row count and the encoding and buffer spans of
+each column.
+
+Column encodings (with an optional null mask of one byte per row):
+
+- int64, float64, bool -- fixed width values
+- date -- int32 proleptic Gregorian ordinal
+- datetime -- int64 microseconds since 1970-01-01 (naive, aware values are
+  converted to UTC)
+- utf8 -- int64 character offsets and a UTF-8 blob of strings
+- bytes -- int64 byte offsets and the raw bytes
+- json -- int64 character offsets and the JSON text of each value; the
+  values of these columns are converted on the client like the JSON path
+"""
+import sys
+import json
+import array
+import base64
+import struct
+import decimal
+import datetime
+from . import serialization
+
+BINARY_CONTENT_TYPE = "application/vnd.yenot.tab2+binary"
+
+_MAGIC = b"YTB1"
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ALIGN = 8
+
+_FIXED_FORMATS = {
+    "int64": "q",
+    "float64": "d",
+    "bool": "b",
+    "date": "i",
+    "datetime": "q",
+}
+
+
+def _pad(length):
+    return -length % _ALIGN
+
+
+def _all(values, *types):
+    return all(v is None or type(v) in types for v in values)
+
+
+def _to_utc_naive(v):
+    if v.tzinfo != None:
+        v = v.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return v
+
+
+def _b64decode(v):
+    return base64.b64decode(v.encode("ascii")) if isinstance(v, str) else bytes(v)
+
+
+def _encode_column(rtype, values):
+    """
+    Return the encoding name and the list of buffers for one column.
+    """
+    nonnull = [v for v in values if v is not None]
+
+    # null values are written as a valid placeholder and masked
+    if rtype == "integer" and _all(nonnull, int):
+        encoding, fixed = "int64", [0 if v is None else v for v in values]
+    elif rtype == "numeric" and _all(nonnull, decimal.Decimal, float, int):
+        fixed = [0.0 if v is None else float(v) for v in values]
+        encoding = "float64"
+    elif rtype == "boolean" and _all(nonnull, bool):
+        encoding, fixed = "bool", [0 if v is None else int(v) for v in values]
+    elif rtype == "date" and _all(nonnull, datetime.date):
+        fixed = [1 if v is None else v.toordinal() for v in values]
+        encoding = "date"
+    elif rtype == "datetime" and _all(nonnull, datetime.datetime):
+        micro = datetime.timedelta(microseconds=1)
+        encoding = "datetime"
+        fixed = [
+            0 if v is None else (_to_utc_naive(v) - _EPOCH) // micro for v in values
+        ]
+    elif rtype == "binary" and _all(nonnull, str, bytes, bytearray, memoryview):
+        items = [b"" if v is None else _b64decode(v) for v in values]
+        encoding = "bytes"
+    elif _all(nonnull, str):
+        encoding, items = "utf8", ["" if v is None else v for v in values]
+    else:
+        encoding = "json"
+        items = ["" if v is None else serialization.serialize(v) for v in values]
+
+    if encoding in _FIXED_FORMATS:
+        buf = array.array(_FIXED_FORMATS[encoding], fixed)
+        if sys.byteorder != "little":
+            buf.byteswap()
+        buffers = [buf.tobytes()]
+    else:
+        offsets = array.array("q", [0])
+        total = 0
+        for item in items:
+            total += len(item)
+            offsets.append(total)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        if encoding == "bytes":
+            blob = b"".join(items)
+        else:
+            blob = "".join(items).encode("utf-8")
+        buffers = [offsets.tobytes(), blob]
+
+    nulls = len(nonnull) < len(values)
+    if nulls:
+        buffers.insert(0, bytes(v is None for v in values))
+    return {"encoding": encoding, "nulls": nulls}, buffers
+
+
+def dumps_binary(keys, tables):
+    """
+    Encode a Yenot result as binary tab2.  `keys` is a dictionary of the
+    non-table values and `tables` maps table names to (columns, rows) tuples.
+
+    >>> cols = [('n', {'type': 'integer'}), ('s', None)]
+    >>> rows = [(1, 'a'), (None, 'b')]
+    >>> result = loads_binary(dumps_binary({}, {'t': (cols, rows)}))
+    >>> columns, table = result['t']
+    >>> list(table[0]), list(table[1])
+    ([1, None], ['a', 'b'])
+    """
+    chunks = []
+    position = 0
+    header = {"keys": keys, "tables": {}}
+
+    for name, (columns, rows) in tables.items():
+        data = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+        if len(data) != len(columns):
+            raise ValueError(f"rows of table {name} do not match the columns")
+
+        encodings = []
+        for (_, meta), values in zip(columns, data):
+            rtype = meta.get("type", None) if isinstance(meta, dict) else None
+            desc, buffers = _encode_column(rtype, values)
+            spans = []
+            for buf in buffers:
+                spans.append([position, len(buf)])
+                chunks.append(buf)
+                chunks.append(b"\0" * _pad(len(buf)))
+                position += len(buf) + _pad(len(buf))
+            desc["buffers"] = spans
+            encodings.append(desc)
+
+        header["tables"][name] = {
+            "columns": columns,
+            "rows": len(rows),
+            "encodings": encodings,
+        }
+
+    head = serialization.serialize(header).encode("utf-8")
+    prefix = _MAGIC + struct.pack("<I", len(head)) + head
+    prefix += b"\0" * _pad(len(prefix))
+    return b"".join([prefix] + chunks)
+
+
+def _cast(view, fmt):
+    if sys.byteorder == "little":
+        return view.cast(fmt)
+    # the data is little-endian; copy and swap on other hosts
+    values = array.array(fmt, view.tobytes())
+    values.byteswap()
+    return memoryview(values)
+
+
+class BinaryColumns:
+    """
+    The column values of a binary tab2 table.  Indexing by column returns a
+    list of Python values decoded from memoryviews of the buffers.  The
+    `native` list flags columns whose values are already their Python types;
+    utf8 and json columns hold the same values as the decoded JSON result.
+    """
+
+    def __init__(self, view, meta):
+        self._view = view
+        self.count = meta["rows"]
+        self.encodings = meta["encodings"]
+        self.native = [
+            e["encoding"] not in ("utf8", "json") for e in self.encodings
+        ]
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def __getitem__(self, index):
+        desc = self.encodings[index]
+        spans = [self._view[o : o + n] for o, n in desc["buffers"]]
+        mask = spans.pop(0) if desc["nulls"] else None
+        encoding = desc["encoding"]
+
+        if encoding in _FIXED_FORMATS:
+            values = _cast(spans[0], _FIXED_FORMATS[encoding]).tolist()
+            if encoding == "bool":
+                values = [v == 1 for v in values]
+            elif encoding == "date":
+                values = list(map(datetime.date.fromordinal, values))
+            elif encoding == "datetime":
+                micro = datetime.timedelta(microseconds=1)
+                values = [_EPOCH + micro * v for v in values]
+        else:
+            offsets = _cast(spans[0], "q").tolist()
+            blob = spans[1]
+            if encoding == "bytes":
+                values = [bytes(blob[a:b]) for a, b in zip(offsets, offsets[1:])]
+            else:
+                text = str(blob, "utf-8")
+                values = [text[a:b] for a, b in zip(offsets, offsets[1:])]
+                if encoding == "json":
+                    values = [json.loads(v) if v else None for v in values]
+
+        if mask != None:
+            values = [None if m else v for v, m in zip(values, mask)]
+        return values
+
+
+def loads_binary(data):
+    """
+    Decode a binary tab2 result to a dictionary like the decoded JSON
+    result.  Tables are given as (columns, BinaryColumns) tuples which may be
+    passed to ClientTable with columnar=True.
+    """
+    view = memoryview(data)
+    if bytes(view[:4]) != _MAGIC:
+        raise ValueError("not a binary tab2 payload")
+    (length,) = struct.unpack("<I", view[4:8])
+    header = json.loads(str(view[8 : 8 + length], "utf-8"))
+    start = 8 + length
+    start += _pad(start)
+    body = view[start:]
+
+    result = dict(header["keys"])
+    for name, meta in header["tables"].items():
+        result[name] = (meta["columns"], BinaryColumns(body, meta))
+    return result
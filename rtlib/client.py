@@ -1,6 +1,13 @@
+import functools
 import contextlib
+import collections.abc
 from . import reportcore
 from . import serialization
+from . import binary
+
+
+# media type of the column-major tab2 variant
+COLUMNAR_CONTENT_TYPE = "application/vnd.yenot.columnar+json"
 
 
 def simple_table(columns, column_map=None):
@@ -9,16 +16,123 @@ def simple_table(columns, column_map=None):
     return ClientTable([(c, column_map.get(c, None)) for c in columns], [])
 
 
+class LazyRows(collections.abc.MutableSequence):
+    """
+    A list of rows which keeps the decoded rows as given and converts each to
+    a DataRow with `factory` on first access.  A bytearray flags the
+    converted rows.
+
+    >>> rows = LazyRows(['1', '2', '3'], int)
+    >>> rows[1], rows.materialized
+    (2, 1)
+    >>> rows.append(4)
+    >>> rows.sort(reverse=True)
+    >>> list(rows), rows.materialized
+    ([4, 3, 2, 1], 4)
+    """
+
+    def __init__(self, rows, factory):
+        self._rows = list(rows)
+        self._done = bytearray(len(self._rows))
+        self._factory = factory
+
+    @property
+    def materialized(self):
+        return len(self._done) - self._done.count(0)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._rows)))]
+        if not self._done[index]:
+            self._rows[index] = self._factory(self._rows[index])
+            self._done[index] = 1
+        return self._rows[index]
+
+    def __iter__(self):
+        for index in range(len(self._rows)):
+            yield self[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._rows[index] = value
+            self._done[index] = b"\x01" * len(value)
+        else:
+            self._rows[index] = value
+            self._done[index] = 1
+
+    def __delitem__(self, index):
+        del self._rows[index]
+        del self._done[index]
+
+    def insert(self, index, value):
+        self._rows.insert(index, value)
+        self._done.insert(index, 1)
+
+    def clear(self):
+        self._rows.clear()
+        self._done.clear()
+
+    def reverse(self):
+        self._rows.reverse()
+        self._done.reverse()
+
+    def materialize(self):
+        """
+        Convert all remaining rows.
+        """
+        for index in range(len(self._rows)):
+            if not self._done[index]:
+                self._rows[index] = self._factory(self._rows[index])
+        self._done = bytearray(b"\x01" * len(self._rows))
+
+    def sort(self, *, key=None, reverse=False):
+        # the key functions are written for DataRow objects
+        self.materialize()
+        self._rows.sort(key=key, reverse=reverse)
+
+    def __repr__(self):
+        return f"<LazyRows {self.materialized}/{len(self)} materialized>"
+
+
 class ClientTable:
     """
     Tabular API from a Yenot serialized table structure with rich type
     information.
+
+    With columnar=True the rows parameter is the column-major form of the
+    table (one list of values per column) as sent to clients accepting
+    :data:`COLUMNAR_CONTENT_TYPE` or the BinaryColumns of a binary tab2
+    table.
+
+    With lazy=True the rows attribute is a :class:`LazyRows` converting each
+    row on first access so that large tables open without converting rows
+    which are never displayed.
     """
 
-    def __init__(self, columns, rows, mixin=None, to_localtime=True):
+    def __init__(
+        self,
+        columns,
+        rows,
+        mixin=None,
+        to_localtime=True,
+        columnar=False,
+        lazy=False,
+    ):
         self.to_localtime = to_localtime
-        f = self.row_factory(columns, mixin=mixin)
-        self.rows = [f(x) for x in rows]
+        if columnar and lazy:
+            f = self.columnar_factory(columns, rows, mixin=mixin)
+            self.rows = LazyRows(zip(*rows), f)
+        elif columnar:
+            self.rows = self.columnar_rows(columns, rows, mixin=mixin)
+        elif lazy:
+            self.rows = LazyRows(rows, self.row_factory(columns, mixin=mixin))
+        else:
+            f = self.row_factory(columns, mixin=mixin)
+            self.rows = [f(x) for x in rows]
 
         # initialize pkey for deletion
         self.columns = reportcore.parse_columns(columns)
@@ -30,6 +144,74 @@ class ClientTable:
     def converter(self, row_field_list):
         return reportcore.as_python(row_field_list, to_localtime=self.to_localtime)
 
+    def column_converters(self, row_field_list):
+        return reportcore.as_python_columns(
+            row_field_list, to_localtime=self.to_localtime
+        )
+
+    def native_converters(self, row_field_list):
+        converters = reportcore.as_client_columns(
+            row_field_list, to_localtime=self.to_localtime
+        )
+        # as_python reads a null boolean as False
+        return [
+            (lambda v: False if v == None else v)
+            if meta != None and meta.get("type", None) == "boolean"
+            else convert
+            for (_, meta), convert in zip(row_field_list, converters)
+        ]
+
+    def _columnar_converters(self, row_field_list, data):
+        converters = self.column_converters(row_field_list)
+        if isinstance(data, binary.BinaryColumns):
+            native = self.native_converters(row_field_list)
+            converters = [
+                n if isnative else c
+                for n, c, isnative in zip(native, converters, data.native)
+            ]
+        return converters
+
+    def columnar_rows(self, row_field_list, data, mixin):
+        self.DataRow = reportcore.fixedrecord(
+            "DataRow", [r[0] for r in row_field_list], mixin=mixin
+        )
+        if len(data) == 0:
+            return []
+
+        # convert a column at a time and skip the columns needing nothing
+        converters = self._columnar_converters(row_field_list, data)
+        data = [
+            values if convert is reportcore.identity else list(map(convert, values))
+            for convert, values in zip(converters, data)
+        ]
+        rows = list(map(self.DataRow, *data))
+        if hasattr(self.DataRow, "_rtlib_init_"):
+            for row in rows:
+                row._rtlib_init_()
+        return rows
+
+    def columnar_factory(self, row_field_list, data, mixin):
+        """
+        Return a function converting a row tuple taken from the column-major
+        data to a DataRow.
+        """
+        self.DataRow = reportcore.fixedrecord(
+            "DataRow", [r[0] for r in row_field_list], mixin=mixin
+        )
+        to_python = functools.partial(
+            reportcore._coerce, self._columnar_converters(row_field_list, data)
+        )
+
+        def init_bare(r):
+            return self.DataRow(*to_python(r))
+
+        def init_custom(r):
+            x = self.DataRow(*to_python(r))
+            x._rtlib_init_()
+            return x
+
+        return init_custom if hasattr(self.DataRow, "_rtlib_init_") else init_bare
+
     def row_factory(self, row_field_list, mixin):
         self.DataRow = reportcore.fixedrecord(
             "DataRow", [r[0] for r in row_field_list], mixin=mixin
@@ -134,3 +316,8 @@ class UnparsingClientTable(ClientTable):
 
     def converter(self, row_field_list):
         return reportcore.as_client(row_field_list, to_localtime=self.to_localtime)
+
+    def column_converters(self, row_field_list):
+        return reportcore.as_client_columns(
+            row_field_list, to_localtime=self.to_localtime
+        )
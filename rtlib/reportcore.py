@@ -274,11 +274,19 @@ def parse_bool(v):
     raise ValueError(f"unacceptable bool import:  {v}")
 
 
-def as_python(columns, to_localtime=True):
-    def coerce(converters, _tuple):
-        return tuple(t(v) for t, v in zip(converters, _tuple))
+def identity(v):
+    return v
+
 
-    identity = lambda v: v
+def _coerce(converters, _tuple):
+    return tuple(t(v) for t, v in zip(converters, _tuple))
+
+
+def as_python_columns(columns, to_localtime=True):
+    """
+    Return a list of functions converting JSON values of each column to
+    their Python type.  Columns needing no conversion get :func:`identity`.
+    """
 
     def column_converter(attr, meta):
         if meta == None or meta.get("type", None) == None:
@@ -307,15 +315,18 @@ def as_python(columns, to_localtime=True):
         else:
             return identity
 
-    converters = [column_converter(*x) for x in columns]
-    return functools.partial(coerce, converters)
+    return [column_converter(*x) for x in columns]
 
 
-def as_client(columns, to_localtime=True):
-    def coerce(converters, _tuple):
-        return tuple(t(v) for t, v in zip(converters, _tuple))
+def as_python(columns, to_localtime=True):
+    return functools.partial(_coerce, as_python_columns(columns, to_localtime))
+
 
-    identity = lambda v: v
+def as_client_columns(columns, to_localtime=True):
+    """
+    This is the :func:`as_python_columns` counterpart for values which are
+    already Python native types.
+    """
 
     def column_converter(attr, meta):
         if meta == None or meta.get("type", None) == None:
@@ -337,5 +348,8 @@ def as_client(columns, to_localtime=True):
         else:
             return identity
 
-    converters = [column_converter(*x) for x in columns]
-    return functools.partial(coerce, converters)
+    return [column_converter(*x) for x in columns]
+
+
+def as_client(columns, to_localtime=True):
+    return functools.partial(_coerce, as_client_columns(columns, to_localtime))
@@ -1,7 +1,9 @@
 import io
+import os
 import json
 import datetime
 import decimal
+import functools
 
 # other places as well, but this is canonical and the others should be swallowed
 
@@ -20,12 +22,185 @@ class DateTimeEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
+def _orjson_default(o):
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, tuple):
+        # orjson only encodes exact tuples; rows are namedtuples
+        return list(o)
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def _orjson_dumps(thing):
+    import orjson
+
+    return orjson.dumps(thing, default=_orjson_default).decode("utf-8")
+
+
+# The json backend is byte-for-byte compatible with json.dumps and
+# DateTimeEncoder.  The orjson backend writes compact (but equivalent) JSON
+# and NaN as null.
+JSON_BACKENDS = {"json": None, "orjson": _orjson_dumps}
+
+_backend_dumps = None
+
+
+def set_json_backend(name):
+    """
+    Select the JSON library used by :func:`serialize` and
+    :func:`serialize_rows`.  The environment variable RTLIB_JSON_BACKEND
+    selects the initial backend.
+    """
+    global _backend_dumps
+    dumps = JSON_BACKENDS[name]
+    if dumps != None:
+        # fail now rather than on first use if the library is not installed
+        dumps([])
+    _backend_dumps = dumps
+
+
+def _fast_dumps(thing):
+    """
+    Return the JSON from the selected backend or None if there is none or it
+    cannot encode the value (for instance integers beyond 64 bits).
+    """
+    if _backend_dumps == None:
+        return None
+    try:
+        return _backend_dumps(thing)
+    except TypeError:
+        return None
+
+
 def serialize(thing, pprint=False):
     if pprint:
         return json.dumps(thing, cls=DateTimeEncoder, indent=4)
-    else:
-        return json.dumps(thing, cls=DateTimeEncoder)
+    result = _fast_dumps(thing)
+    if result == None:
+        result = json.dumps(thing, cls=DateTimeEncoder)
+    return result
 
 
 def to_json(thing):
     return io.BytesIO(serialize(thing).encode("utf8"))
+
+
+# The compiled encoders below convert the values of typed columns to the
+# JSON native values DateTimeEncoder.default would return for them and then
+# encode the whole batch with the C encoder of json.dumps.
+
+_encode_generic = DateTimeEncoder().encode
+
+_ISOFORMAT_TYPES = frozenset([datetime.date, datetime.datetime, datetime.time])
+
+# generated expression for values of each rtlib type; other types pass as-is
+_COLUMN_EXPRESSIONS = {
+    "date": "{v}.isoformat() if type({v}) in isotypes else {v}",
+    "datetime": "{v}.isoformat() if type({v}) in isotypes else {v}",
+    "numeric": "float({v}) if type({v}) is Decimal else {v}",
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_row_encoder(types):
+    names = [f"v{i}" for i in range(len(types))]
+    template = "".join(
+        f"{_COLUMN_EXPRESSIONS[t].format(v=n)}, "
+        if t in _COLUMN_EXPRESSIONS
+        else f"{n}, "
+        for n, t in zip(names, types)
+    )
+    target = "".join(f"{n}, " for n in names)
+
+    if template == target:
+        # nothing to convert
+        return _encode_generic
+
+    source = f"""\
+def encode_rows(rows):
+    return encode([({template}) for ({target}) in rows])
+"""
+    scope = {
+        "encode": _encode_generic,
+        "isotypes": _ISOFORMAT_TYPES,
+        "Decimal": decimal.Decimal,
+    }
+    exec(source, scope)
+    return scope["encode_rows"]
+
+
+def row_encoder(columns):
+    """
+    Return a function which encodes a list of rows of the tab2 columns as
+    JSON.  The encoder is compiled once per sequence of column types with a
+    fixed conversion per column.
+
+    >>> encode = row_encoder([('d', {'type': 'date'}), ('n', None)])
+    >>> encode([(datetime.date(2020, 3, 1), 'x'), (None, 2.5)])
+    '[["2020-03-01", "x"], [null, 2.5]]'
+    """
+    types = tuple(
+        meta.get("type", None) if isinstance(meta, dict) else None
+        for _, meta in columns
+    )
+    return _compile_row_encoder(types)
+
+
+def _columnar_converter(rtype):
+    expression = _COLUMN_EXPRESSIONS[rtype].format(v="v")
+    scope = {"isotypes": _ISOFORMAT_TYPES, "Decimal": decimal.Decimal}
+    return eval(f"lambda column: [{expression} for v in column]", scope)
+
+
+_COLUMNAR_CONVERTERS = {t: _columnar_converter(t) for t in _COLUMN_EXPRESSIONS}
+
+
+def serialize_columnar(columns, rows):
+    """
+    Serialize the rows of a tab2 table in column-major form, that is as a list
+    with one array of values for each column.
+
+    >>> cols = [('a', {'type': 'date'}), ('b', None)]
+    >>> serialize_columnar(cols, [(datetime.date(2020, 3, 1), 1), (None, 2)])
+    '[["2020-03-01", null], [1, 2]]'
+    >>> serialize_columnar(cols, [])
+    '[[], []]'
+    """
+    data = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+    if len(data) != len(columns):
+        raise ValueError("rows do not match the columns")
+    result = _fast_dumps(data)
+    if result != None:
+        return result
+    converted = []
+    for (_, meta), values in zip(columns, data):
+        rtype = meta.get("type", None) if isinstance(meta, dict) else None
+        convert = _COLUMNAR_CONVERTERS.get(rtype, None)
+        converted.append(values if convert == None else convert(values))
+    return _encode_generic(converted)
+
+
+def serialize_rows(columns, rows):
+    """
+    Serialize the rows of a tab2 table.  The result is identical to
+    :func:`serialize` applied to the rows.
+
+    >>> cols = [('a', {'type': 'numeric'}), ('b', {'type': 'datetime'})]
+    >>> rows = [(decimal.Decimal('1.10'), datetime.datetime(2020, 3, 1, 8, 30))]
+    >>> serialize_rows(cols, rows) == serialize(rows)
+    True
+    """
+    if _backend_dumps != None:
+        # plain tuples spare a call of the default hook for each row
+        result = _fast_dumps(list(map(tuple, rows)))
+        if result != None:
+            return result
+    try:
+        return row_encoder(columns)(rows)
+    except (TypeError, ValueError):
+        # rows not matching the columns; let the general encoder sort it out
+        return serialize(rows)
+
+
+if os.getenv("RTLIB_JSON_BACKEND", None):
+    set_json_backend(os.environ["RTLIB_JSON_BACKEND"])
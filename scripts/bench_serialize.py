@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Compare rtlib.serialize with the compiled tab2 row encoder on a synthetic
+wide numeric/date report.  The rows are namedtuples as returned by sql_tab2
+and the reported timings are the median of the repeated runs.
+"""
+import sys
+import time
+import random
+import statistics
+import collections
+import decimal
+import datetime
+import argparse
+import rtlib
+
+
+def sample_table(count):
+    columns = [
+        ("id", {"type": "integer"}),
+        ("name", None),
+        ("posted", {"type": "date"}),
+        ("updated", {"type": "datetime"}),
+        ("debit", {"type": "numeric"}),
+        ("credit", {"type": "numeric"}),
+        ("balance", {"type": "numeric"}),
+        ("closed", {"type": "boolean"}),
+    ]
+    Row = collections.namedtuple("Row", [name for name, _ in columns])
+    start = datetime.datetime(2020, 1, 1)
+    rows = []
+    for index in range(count):
+        stamp = start + datetime.timedelta(minutes=index)
+        amount = decimal.Decimal(random.randint(0, 10**7)) / 100
+        rows.append(
+            Row(
+                index,
+                f"account {index % 97}",
+                stamp.date(),
+                stamp,
+                amount,
+                None if index % 3 else amount,
+                amount * 3,
+                index % 2 == 0,
+            )
+        )
+    return columns, rows
+
+
+def median_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - t0)
+    return statistics.median(timings), result
+
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser("benchmark tab2 row serialization")
+    parse.add_argument("--rows", type=int, default=100000)
+    parse.add_argument("--repeat", type=int, default=11)
+    args = parse.parse_args()
+
+    columns, rows = sample_table(args.rows)
+
+    generic, expected = median_of(args.repeat, lambda: rtlib.serialize(rows))
+    compiled, actual = median_of(
+        args.repeat, lambda: rtlib.serialize_rows(columns, rows)
+    )
+
+    print(f"rows:              {args.rows:,}")
+    print(f"DateTimeEncoder:   {generic * 1000:.1f} ms")
+    print(f"compiled encoder:  {compiled * 1000:.1f} ms")
+    print(f"speedup:           {generic / compiled:.2f}x")
+    print(f"identical output:  {expected == actual}")
+
+    try:
+        rtlib.set_json_backend("orjson")
+    except ImportError:
+        pass
+    else:
+        backend, _ = median_of(
+            args.repeat, lambda: rtlib.serialize_rows(columns, rows)
+        )
+        rtlib.set_json_backend("json")
+        print(f"orjson backend:    {backend * 1000:.1f} ms (compact output)")
+    sys.exit(0 if expected == actual else 1)
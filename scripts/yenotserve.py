@@ -19,13 +19,25 @@ if __name__ == "__main__":
     parse.add_argument(
         "--sitevar", action="append", default=[], help="add site variable"
     )
+    parse.add_argument(
+        "--replica",
+        action="append",
+        default=[],
+        help="database url of a read replica for readonly connections",
+    )
+    parse.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes sharing the listening socket",
+    )
 
     import logging
     logging.basicConfig(level=logging.DEBUG)
 
     args = parse.parse_args()
 
-    app = yenot.backend.init_application(args.dburl)
+    app = yenot.backend.init_application(args.dburl, replicas=args.replica)
 
     app.add_sitevars(args.sitevar)
 
@@ -44,5 +56,8 @@ if __name__ == "__main__":
     else:
         kwargs = {}
 
-    # debugging & development service
-    app.run(**kwargs)
+    if args.workers > 1:
+        app.run_workers(args.workers)
+    else:
+        # debugging & development service
+        app.run(**kwargs)
@@ -0,0 +1,58 @@
+import asyncio
+import json
+from yenot.backend import misc
+
+
+def stream_rows(data, size):
+    async def chunks():
+        for offset in range(0, len(data), size):
+            yield data[offset : offset + size]
+
+    async def read():
+        stream = await misc.InboundTableStream.open(
+            chunks(), options=["id", "name"], batch_rows=3
+        )
+        rows = []
+        async for batch in stream.batches():
+            rows += [(r.id, r.name) for r in batch]
+        return stream.deleted_keys, rows
+
+    return asyncio.run(read())
+
+
+def test_tab3_stream_across_chunk_sizes():
+    rows = [[i, f"näme {i}"] for i in range(10)]
+    data = json.dumps([{"deleted": [[99]]}, ["id", "name"], rows]).encode("utf8")
+    # every size splits elements (and the multibyte character) differently
+    for size in [1, 2, 7, 64, len(data)]:
+        deleted, read = stream_rows(data, size)
+        assert deleted == [[99]]
+        assert read == [tuple(r) for r in rows]
+
+
+def test_tab3_stream_invalid_rows_are_user_errors():
+    async def read(data):
+        async def chunks():
+            # one byte at a time so that the header is read on its own
+            for offset in range(len(data)):
+                yield data[offset : offset + 1]
+
+        stream = await misc.InboundTableStream.open(chunks(), options=["id"])
+        stream.name = "things"
+        async for batch in stream.batches():
+            pass
+
+    invalid = [
+        b'[{}, ["id"], [[1], [2, 3]]]',
+        b'[{}, ["id"], [[1], [2]',
+        b'[{}, ["id"], [[1]]] []',
+        b'[{}, ["id"], [[1]]] \xff',
+    ]
+    for data in invalid:
+        try:
+            asyncio.run(read(data))
+        except misc.UserError as e:
+            assert e.key == "invalid-collection"
+            assert e.status == 403
+        else:
+            assert False, data
@@ -0,0 +1,36 @@
+import asyncio
+import types
+import aiohttp.web as web
+from aiohttp.test_utils import TestClient, TestServer
+from yenot.backend import plugins
+
+
+def test_deadline_header_must_be_positive_seconds():
+    yapp = types.SimpleNamespace(route_options={"thing": {}})
+
+    async def thing(request):
+        return web.Response(text="thing")
+
+    app = web.Application(
+        middlewares=[
+            plugins.exception_middleware(yapp),
+            plugins.deadline_middleware(yapp),
+        ]
+    )
+    app.router.add_get("/api/thing", thing, name="thing")
+
+    async def statuses():
+        async with TestClient(TestServer(app)) as client:
+            result = {}
+            for value in ["2.5", "soon", "nan", "inf", "-inf", "0", "-1"]:
+                response = await client.get(
+                    "/api/thing", headers={plugins.DEADLINE_HEADER: value}
+                )
+                keys = await response.json() if response.status != 200 else None
+                result[value] = (response.status, keys and keys[0]["error-key"])
+            return result
+
+    result = asyncio.run(statuses())
+    assert result.pop("2.5") == (200, None)
+    for value, answer in result.items():
+        assert answer == (400, "invalid-param"), value
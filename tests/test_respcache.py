@@ -0,0 +1,67 @@
+import asyncio
+import types
+import aiohttp.web as web
+from aiohttp.test_utils import TestClient, TestServer
+from yenot.backend import respcache
+
+
+def cached_app(options, handler):
+    """
+    Return an aiohttp application serving GET /api/thing/{id} through the
+    cache middleware with the route options.
+    """
+    yapp = types.SimpleNamespace(route_options={"thing": options})
+    app = web.Application(middlewares=[respcache.cache_middleware(yapp)])
+    app.router.add_get("/api/thing/{id}", handler, name="thing")
+    return app
+
+
+def test_cache_key_has_path_parameters():
+    calls = []
+
+    async def thing(request):
+        calls.append(request.match_info["id"])
+        return web.Response(text=f"thing {request.match_info['id']}")
+
+    app = cached_app({"cache": 60}, thing)
+
+    async def sequential():
+        respcache.response_cache.clear()
+        async with TestClient(TestServer(app)) as client:
+            bodies = []
+            for path in ["/api/thing/1", "/api/thing/2", "/api/thing/1"]:
+                response = await client.get(path)
+                bodies.append(await response.text())
+            return bodies
+
+    bodies = asyncio.run(sequential())
+    assert bodies == ["thing 1", "thing 2", "thing 1"]
+    # the third request is a hit
+    assert calls == ["1", "2"]
+
+
+def test_single_flight_keeps_path_parameters_apart():
+    calls = []
+
+    async def thing(request):
+        calls.append(request.match_info["id"])
+        # long enough for the concurrent requests to overlap
+        await asyncio.sleep(0.1)
+        return web.Response(text=f"thing {request.match_info['id']}")
+
+    app = cached_app({"singleflight": True}, thing)
+
+    async def concurrent():
+        async with TestClient(TestServer(app)) as client:
+
+            async def get(path):
+                response = await client.get(path)
+                return await response.text()
+
+            paths = ["/api/thing/1", "/api/thing/2"] * 3
+            return await asyncio.gather(*[get(p) for p in paths])
+
+    bodies = asyncio.run(concurrent())
+    assert bodies == ["thing 1", "thing 2"] * 3
+    # one execution per path parameter
+    assert sorted(calls) == ["1", "2"]
@@ -0,0 +1,62 @@
+import asyncio
+import types
+from yenot.backend import sqlread
+
+
+class FakeConnection:
+    def __init__(self):
+        self.listeners = []
+
+    def add_termination_listener(self, callback):
+        self.listeners.append(callback)
+
+    async def prepare(self, sql, timeout=None):
+        return (self, sql)
+
+    def terminate(self, proxy):
+        # asyncpg calls the listeners with the pool proxy of the connection
+        for callback in self.listeners:
+            callback(proxy)
+
+
+class FakeProxy:
+    def __init__(self, con):
+        self._con = con
+
+    async def prepare(self, sql, timeout=None):
+        return await self._con.prepare(sql, timeout)
+
+
+def test_statement_cache_dropped_on_termination():
+    raw = FakeConnection()
+    proxy = FakeProxy(raw)
+    asyncio.run(sqlread._prepare(proxy, "select 1"))
+    assert raw in sqlread._statement_caches
+
+    raw.terminate(proxy)
+    assert raw not in sqlread._statement_caches
+
+
+class FakePrepared:
+    def __init__(self, *columns):
+        self.attributes = [
+            types.SimpleNamespace(name=name, type=types.SimpleNamespace(oid=oid))
+            for name, oid in columns
+        ]
+
+    def get_attributes(self):
+        return self.attributes
+
+
+def test_tab2_metadata_follows_result_columns():
+    # int4 and text oids are below the first user oid; no domain lookup
+    sql = "select * from test_tab2_metadata"
+    sqlread.invalidate_tab2_metadata()
+    before = FakePrepared(("id", 23))
+    columns, _ = asyncio.run(sqlread._tab2_metadata(None, before, sql))
+    assert [name for name, _ in columns] == ["id"]
+
+    after = FakePrepared(("id", 23), ("name", 25))
+    columns, RowType = asyncio.run(sqlread._tab2_metadata(None, after, sql))
+    assert [name for name, _ in columns] == ["id", "name"]
+    assert RowType._fields == ("id", "name")
@@ -0,0 +1,22 @@
+from yenot.backend import sqlwrite
+
+
+def mogrifier(table):
+    m = sqlwrite.TableSaveMogrification()
+    m.table = table
+    return m
+
+
+def test_upsert_defaults_missing_primary_key():
+    sql = mogrifier("items").upsert_statement(["id", "name"], ["id"])
+    assert "defaulted as" in sql
+    assert 'insert into items ("name")' in sql
+    assert 'where "id" is not null' in sql
+
+
+def test_upsert_primary_key_only_table():
+    sql = mogrifier("tags").upsert_statement(["id"], ["id"])
+    assert "defaulted as" not in sql
+    assert "insert into tags ()" not in sql
+    assert "select  from" not in sql
+    assert 'on conflict ("id") do nothing' in sql
@@ -1,17 +1,25 @@
-#from bottle import response
+import logging
+import aiohttp.web as web
+from aiohttp import hdrs
 import rtlib
 from . import sqlread
 from . import sqlwrite
 from . import misc
+from . import compression
+from . import respcache
+from . import metrics
 
 sql_tab2 = sqlread.sql_tab2
+sql_tab2_stream = sqlread.sql_tab2_stream
 sql_1row = sqlread.sql_1row
 sql_1object = sqlread.sql_1object
 sql_rows = sqlread.sql_rows
 sql_void = sqlread.sql_void
 writeblock = sqlwrite.writeblock
+invalidate_cache = respcache.invalidate
 UserError = misc.UserError
 table_from_tab2 = misc.table_from_tab2
+table_stream_from_tab3 = misc.table_stream_from_tab3
 
 parse_date = rtlib.parse_date
 parse_bool = rtlib.parse_bool
@@ -22,6 +30,8 @@ tab2_columns_transform = misc.tab2_columns_transform
 tab2_rows_transform = misc.tab2_rows_transform
 tab2_rows_default = misc.tab2_rows_default
 
+logger = logging.getLogger(__name__)
+
 sanitize_prefix = sqlread.sanitize_prefix
 sanitize_fts = sqlread.sanitize_fts
 sanitize_fragment = sqlread.sanitize_fragment
@@ -33,6 +43,73 @@ def get_global_app():
     return plugins.global_app
 
 
+def get_request():
+    """
+    Return the aiohttp request handled by the current task.
+    """
+    from . import plugins
+
+    return plugins.current_request.get()
+
+
+# the tab2 variants in order of preference among equal quality values;
+# the others are only sent when explicitly accepted
+RESULT_MEDIA_TYPES = [
+    rtlib.BINARY_CONTENT_TYPE,
+    rtlib.COLUMNAR_CONTENT_TYPE,
+    "application/json",
+]
+
+
+def preferred_media_type(accept):
+    """
+    Return the media type of RESULT_MEDIA_TYPES to send for the Accept
+    header value.
+
+    >>> preferred_media_type('application/vnd.yenot.columnar+json, */*;q=0.5')
+    'application/vnd.yenot.columnar+json'
+    >>> preferred_media_type('application/vnd.yenot.tab2+binary;q=0, */*')
+    'application/json'
+    >>> preferred_media_type('')
+    'application/json'
+    """
+    # media ranges share the syntax of Accept-Encoding; parameters other
+    # than q are ignored
+    accepted = compression.parse_accept_encoding(accept)
+    default = max(accepted.get("*/*", 0.0), accepted.get("application/*", 0.0))
+    if len(accepted) == 0:
+        default = 1.0
+    best, best_quality = "application/json", 0.0
+    for media in RESULT_MEDIA_TYPES:
+        if media == "application/json":
+            quality = accepted.get(media, default)
+        else:
+            quality = accepted.get(media, 0.0)
+        if quality > best_quality:
+            best, best_quality = media, quality
+    return best
+
+
+def _preferred_media_type(request):
+    if request == None:
+        return "application/json"
+    return preferred_media_type(request.headers.get(hdrs.ACCEPT, ""))
+
+
+def accepts_columnar(request):
+    """
+    Return True if the client prefers the column-major tab2 variant.
+    """
+    return _preferred_media_type(request) == rtlib.COLUMNAR_CONTENT_TYPE
+
+
+def accepts_binary(request):
+    """
+    Return True if the client prefers the binary tab2 encoding.
+    """
+    return _preferred_media_type(request) == rtlib.BINARY_CONTENT_TYPE
+
+
 app_init_functions = []
 data_init_functions = []
 
@@ -47,6 +124,11 @@ def add_data_init(ff):
     data_init_functions.append(ff)
 
 
+# rows per serialization batch and approximate bytes per write when streaming
+STREAM_BATCH_ROWS = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
 class Results:
     """
     This class codifies the expected output of Yenot standard json.  A number if
@@ -62,6 +144,8 @@ class Results:
         self.keys = {"headers": []}
         self._main_name = None
         self._t = {}
+        # rows of streamed tables written by json_fragments
+        self._streamed_rows = 0
         if default_title:
             self.key_labels += get_global_app().request_content_title()
 
@@ -93,7 +177,7 @@ class Results:
     @property
     def tables(self):
         # Support:
-        # results.tables['<tname>'] = api.sql_tab2(...)
+        # results.tables['<tname>'] = await api.sql_tab2(...)
         class _:
             def __setitem__(_self, index, value):
                 main = False
@@ -112,7 +196,10 @@ class Results:
 
     def finalize(self):
         if "summary" not in self.keys and self._main_name != None:
-            self.keys["summary"] = f"{len(self._t[self._main_name][1]):,} rows"
+            rows = self._t[self._main_name][1]
+            # streamed rows are not counted until they are written
+            if hasattr(rows, "__len__"):
+                self.keys["summary"] = f"{len(rows):,} rows"
 
     def plain_old_python(self):
         self.finalize()
@@ -130,18 +217,189 @@ class Results:
 
     def json_out(self):
         """
-        Set the bottle response header content type and flatten the values in
-        this object to the Yenot JSON format.  Typically this is used as the
-        return value of a JSON returning end-point.
+        Flatten the values in this object to the Yenot JSON format and return
+        an aiohttp response with the json content type.  Typically this is
+        used as the return value of a JSON returning end-point.
+
+        Tables are sent in column-major form if the request accepts
+        rtlib.COLUMNAR_CONTENT_TYPE and binary encoded if the request accepts
+        rtlib.BINARY_CONTENT_TYPE.
 
         .. code-block:: python
 
             results = api.Results()
             return results.json_out()
         """
-        response.content_type = "application/json; charset=UTF-8"
+        request = get_request()
+        if accepts_binary(request):
+            return self.binary_out()
+
+        columnar = accepts_columnar(request)
+        with metrics.phase("results"):
+            pyobj = self.plain_old_python()
+        with metrics.phase("encode"):
+            fields = [
+                f"{rtlib.serialize(k)}: {self._serialize_value(k, v, columnar)}"
+                for k, v in pyobj.items()
+            ]
+            body = ("{" + ", ".join(fields) + "}").encode("utf-8")
+        self._record(request, len(body))
+        response = web.Response(
+            body=body,
+            content_type=self._content_type(columnar),
+            charset="utf-8",
+        )
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT)
+        return response
+
+    def binary_out(self):
+        """
+        Return an aiohttp response with this object in the binary tab2
+        encoding of :func:`rtlib.dumps_binary`.
+        """
+        with metrics.phase("results"):
+            pyobj = self.plain_old_python()
+        keys = {k: v for k, v in pyobj.items() if not self._is_table(k, v)}
+        tables = {k: v for k, v in pyobj.items() if self._is_table(k, v)}
+        with metrics.phase("encode"):
+            body = rtlib.dumps_binary(keys, tables)
+        self._record(get_request(), len(body))
+        response = web.Response(body=body, content_type=rtlib.BINARY_CONTENT_TYPE)
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT)
+        return response
+
+    def _record(self, request, nbytes):
+        rows = self._streamed_rows
+        for key, value in self._t.items():
+            if self._is_table(key, value) and hasattr(value[1], "__len__"):
+                rows += len(value[1])
+        metrics.record_result(request, rows, nbytes)
+
+    @staticmethod
+    def _content_type(columnar):
+        return rtlib.COLUMNAR_CONTENT_TYPE if columnar else "application/json"
+
+    def _is_table(self, key, value):
+        return key in self._t and isinstance(value, tuple) and len(value) == 2
+
+    def _serialize_value(self, key, value, columnar=False):
+        # tables use the row encoder compiled for their column types
+        if self._is_table(key, value):
+            columns, rows = value
+            if columnar:
+                encoded = rtlib.serialize_columnar(columns, rows)
+            else:
+                encoded = rtlib.serialize_rows(columns, rows)
+            return f"[{rtlib.serialize(columns)}, {encoded}]"
+        return rtlib.serialize(value)
+
+    async def json_fragments(
+        self, batch_rows=STREAM_BATCH_ROWS, columnar=False
+    ):
+        """
+        Generate the Yenot JSON format of this object as a sequence of string
+        fragments.  The concatenation of the fragments is identical to the
+        body returned by :meth:`json_out`, but rows of each table are only
+        serialized `batch_rows` at a time.  The rows of a table may also be an
+        async iterator of row batches as returned by :func:`sql_tab2_stream`.
+
+        A columnar table can only be written once all of its rows are read.
+        """
         pyobj = self.plain_old_python()
-        return rtlib.serialize(pyobj).encode("utf-8")
+
+        yield "{"
+        for index, (key, value) in enumerate(pyobj.items()):
+            prefix = ", " if index > 0 else ""
+            yield f"{prefix}{rtlib.serialize(key)}: "
+            if columnar and self._is_table(key, value):
+                columns, rows = value
+                if hasattr(rows, "__aiter__"):
+                    rows = [row async for batch in rows for row in batch]
+                    self._streamed_rows += len(rows)
+                yield self._serialize_value(key, (columns, rows), columnar=True)
+            elif self._is_table(key, value):
+                columns, rows = value
+                yield f"[{rtlib.serialize(columns)}, ["
+                first = True
+                if hasattr(rows, "__aiter__"):
+                    async for batch in rows:
+                        self._streamed_rows += len(batch)
+                        if len(batch) > 0:
+                            batch = rtlib.serialize_rows(columns, batch)
+                            yield ("" if first else ", ") + batch[1:-1]
+                            first = False
+                else:
+                    for offset in range(0, len(rows), batch_rows):
+                        batch = rows[offset : offset + batch_rows]
+                        batch = rtlib.serialize_rows(columns, batch)
+                        yield ("" if first else ", ") + batch[1:-1]
+                        first = False
+                yield "]]"
+            else:
+                yield rtlib.serialize(value)
+        yield "}"
+
+    async def json_stream(self, request, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Write this object in the Yenot JSON format to a chunked aiohttp
+        StreamResponse.  Rows are serialized incrementally and each chunk
+        waits for the transport to drain so that a slow client does not cause
+        the entire payload to be buffered in memory.
+
+        Errors after the headers are sent cannot be answered with an error
+        response; the connection is aborted so that the client sees a
+        truncated chunked body.
+
+        .. code-block:: python
+
+            results = api.Results()
+            return await results.json_stream(request)
+        """
+        if accepts_binary(request):
+            # the binary encoding is written in one piece
+            for tname, value in list(self._t.items()):
+                if self._is_table(tname, value) and hasattr(value[1], "__aiter__"):
+                    rows = [row async for batch in value[1] for row in batch]
+                    self._t[tname] = value[0], rows
+            return self.binary_out()
+
+        columnar = accepts_columnar(request)
+        response = web.StreamResponse()
+        response.content_type = self._content_type(columnar)
+        response.charset = "utf-8"
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT)
+        response.enable_chunked_encoding()
+        compression.enable_stream_compression(get_global_app(), request, response)
+        # an expired deadline is still reported as an error response here
+        sqlread.remaining_time()
+        await response.prepare(request)
+
+        pending = []
+        size = 0
+        written = 0
+        try:
+            async for fragment in self.json_fragments(columnar=columnar):
+                pending.append(fragment)
+                size += len(fragment)
+                if size >= chunk_size:
+                    # write waits on the transport when the client is slow
+                    chunk = "".join(pending).encode("utf-8")
+                    await response.write(chunk)
+                    written += len(chunk)
+                    pending = []
+                    size = 0
+            if pending:
+                chunk = "".join(pending).encode("utf-8")
+                await response.write(chunk)
+                written += len(chunk)
+        except Exception:
+            logger.exception(f"aborted stream after {written} bytes")
+            if request.transport != None:
+                request.transport.abort()
+            return response
+        await response.write_eof()
+        self._record(request, written)
+        return response
 
 
 class ColumnGenerator:
@@ -0,0 +1,178 @@
+"""
+Response compression negotiated from the Accept-Encoding request header.
+
+Routes may pass compress=False to opt out or compress_level=<n> to trade
+CPU for bandwidth.  Bodies of COMPRESSION_OFFLOAD_SIZE bytes or more are
+compressed in the default thread pool executor so that the event loop keeps
+serving other requests.
+"""
+import zlib
+import asyncio
+import aiohttp.web as web
+from aiohttp import hdrs
+from . import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bodies smaller than this are sent as-is
+COMPRESSION_MIN_SIZE = 1024
+# bodies at least this large are compressed off of the event loop
+COMPRESSION_OFFLOAD_SIZE = 256 * 1024
+
+DEFAULT_LEVELS = {"zstd": 3, "br": 5, "gzip": 6}
+
+
+def _gzip(body, level):
+    # wbits 16+ writes the gzip container
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _brotli(body, level):
+    return brotli.compress(body, quality=level)
+
+
+def _zstd(body, level):
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+# in order of preference when the client weighs them equally
+CODECS = {}
+if zstandard != None:
+    CODECS["zstd"] = _zstd
+if brotli != None:
+    CODECS["br"] = _brotli
+CODECS["gzip"] = _gzip
+
+
+def parse_accept_encoding(header):
+    """
+    Return a dictionary of content codings to their quality values.
+
+    >>> parse_accept_encoding('gzip, br;q=0.5, identity;q=0')
+    {'gzip': 1.0, 'br': 0.5, 'identity': 0.0}
+    """
+    result = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        if coding == "":
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        result[coding.lower()] = quality
+    return result
+
+
+def choose_encoding(header, codecs=None):
+    """
+    Return the preferred available content coding accepted by the client or
+    None.
+
+    >>> choose_encoding('deflate, gzip;q=0.8', codecs=['br', 'gzip'])
+    'gzip'
+    >>> choose_encoding('*', codecs=['br', 'gzip'])
+    'br'
+    >>> choose_encoding('identity', codecs=['br', 'gzip']) == None
+    True
+    """
+    if not header:
+        return None
+    if codecs == None:
+        codecs = list(CODECS)
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+
+    best, best_quality = None, 0.0
+    for coding in codecs:
+        quality = accepted.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def route_options(yapp, request):
+    route = request.match_info.route
+    return yapp.route_options.get(route.name, {}) if route != None else {}
+
+
+def negotiated_encoding(yapp, request):
+    """
+    Return the content coding for complete bodies of the route of the
+    request or None.
+    """
+    if not route_options(yapp, request).get("compress", True):
+        return None
+    return choose_encoding(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+
+
+def compression_middleware(yapp):
+    """
+    Return an aiohttp middleware compressing the complete bodies of
+    responses from routes of the YenotApplication `yapp`.  Streamed responses
+    are compressed by aiohttp; see :func:`enable_stream_compression`.
+    """
+
+    @web.middleware
+    async def compress_response(request, handler):
+        response = await handler(request)
+
+        if (
+            type(response) is not web.Response
+            or not isinstance(response.body, bytes)
+            or hdrs.CONTENT_ENCODING in response.headers
+        ):
+            return response
+
+        coding = negotiated_encoding(yapp, request)
+        if route_options(yapp, request).get("compress", True):
+            # shared caches must not send an identity body to clients
+            # accepting compression
+            response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        if coding == None or len(response.body) < COMPRESSION_MIN_SIZE:
+            return response
+
+        options = route_options(yapp, request)
+        level = options.get("compress_level", DEFAULT_LEVELS[coding])
+        body = response.body
+        with metrics.phase("compress"):
+            if len(body) >= COMPRESSION_OFFLOAD_SIZE:
+                loop = asyncio.get_running_loop()
+                body = await loop.run_in_executor(None, CODECS[coding], body, level)
+            else:
+                body = CODECS[coding](body, level)
+
+        response.body = body
+        response.headers[hdrs.CONTENT_ENCODING] = coding
+        return response
+
+    return compress_response
+
+
+def enable_stream_compression(yapp, request, response):
+    """
+    Enable incremental gzip compression of a StreamResponse before it is
+    prepared if the client and route allow it.
+    """
+    options = route_options(yapp, request) if yapp != None else {}
+    if not options.get("compress", True):
+        return
+    response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+    coding = choose_encoding(
+        request.headers.get(hdrs.ACCEPT_ENCODING, ""), codecs=["gzip"]
+    )
+    if coding != None:
+        response.enable_compression(web.ContentCoding.gzip)
@@ -0,0 +1,434 @@
+"""
+Lightweight in-process statistics of the Yenot server and their Prometheus
+text exposition.  Recording is a few counter increments per request; with
+several worker processes each reports its own figures.
+"""
+import io
+import json
+import time
+import bisect
+import pstats
+import asyncio
+import logging
+import cProfile
+import contextlib
+import contextvars
+import collections
+import aiohttp.web as web
+
+timing_logger = logging.getLogger("yenot.timing")
+profile_logger = logging.getLogger("yenot.profile")
+
+# upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Count observations in buckets by upper bound and keep their sum and
+    maximum.
+
+    >>> h = Histogram(buckets=(0.1, 1.0))
+    >>> for v in (0.05, 0.5, 3.0):
+    ...     h.observe(v)
+    >>> h.stats()["buckets"]
+    {0.1: 1, 1.0: 2, inf: 3}
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def stats(self):
+        """
+        Return the count, sum, maximum and the cumulative bucket counts by
+        upper bound.
+        """
+        cumulative = {}
+        total = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            total += n
+            cumulative[bound] = total
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": cumulative,
+        }
+
+
+class RouteStats:
+    """
+    Request statistics of one route.
+    """
+
+    __slots__ = ("responses", "in_flight", "latency", "rows", "bytes")
+
+    def __init__(self):
+        self.responses = collections.Counter()
+        self.in_flight = 0
+        self.latency = Histogram()
+        self.rows = 0
+        self.bytes = 0
+
+
+# RouteStats by route name; these are per process
+route_stats = collections.defaultdict(RouteStats)
+
+
+def _route_name(request):
+    route = request.match_info.route if request != None else None
+    return route.name if route != None and route.name != None else "unmatched"
+
+
+def record_result(request, rows, nbytes):
+    """
+    Add the rows and bytes of a serialized Results object to the statistics
+    of the route of the request.
+    """
+    stats = route_stats[_route_name(request)]
+    stats.rows += rows
+    stats.bytes += nbytes
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    stats = route_stats[_route_name(request)]
+    stats.in_flight += 1
+    status = 500
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # nginx's code for a client closing the connection
+        status = 499
+        raise
+    finally:
+        stats.latency.observe(time.perf_counter() - start)
+        stats.responses[status] += 1
+        stats.in_flight -= 1
+
+
+class PhaseTimer:
+    """
+    Accumulated seconds and counts of the phases of one request.
+    """
+
+    __slots__ = ("phases",)
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        total, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (total + seconds, count + 1)
+
+    def server_timing(self, total):
+        """
+        Return the value of a Server-Timing header for the phases.
+
+        >>> timer = PhaseTimer()
+        >>> timer.add('sql', 0.0125)
+        >>> timer.add('sql', 0.0025)
+        >>> timer.server_timing(0.02)
+        'sql;dur=15.00;desc="2 calls", total;dur=20.00'
+        """
+        items = [
+            f'{name};dur={seconds * 1000:.2f};desc="{count} calls"'
+            for name, (seconds, count) in self.phases.items()
+        ]
+        items.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(items)
+
+
+# the PhaseTimer of the request handled in the current task
+request_timer = contextvars.ContextVar("yenot_request_timer", default=None)
+
+
+def add_phase(name, seconds):
+    """
+    Add time spent in a phase to the timer of the current request if any.
+    """
+    timer = request_timer.get()
+    if timer != None:
+        timer.add(name, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+
+
+PROFILE_HEADER = "X-Yenot-Profile"
+# lines of cumulative profile statistics logged per profiled request
+PROFILE_LINES = 40
+
+# cProfile cannot profile two requests at once
+_profiling = False
+
+
+async def _profiled(request, handler):
+    global _profiling
+    profile = cProfile.Profile()
+    _profiling = True
+    profile.enable()
+    try:
+        return await handler(request)
+    finally:
+        profile.disable()
+        _profiling = False
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        profile_logger.info(
+            f"profile of {request.method} {request.path_qs}\n{out.getvalue()}"
+        )
+
+
+def timing_middleware(yapp):
+    """
+    Return an aiohttp middleware timing the phases of each request.  The
+    phases are sent in a Server-Timing header (unless the response was
+    streamed) and logged as a JSON line to the yenot.timing logger.
+
+    If yapp.allow_profiling is set, a request with the X-Yenot-Profile header
+    is run under cProfile and the statistics are logged to the yenot.profile
+    logger.  The profile covers all tasks of the event loop while the request
+    runs.
+    """
+
+    @web.middleware
+    async def timing(request, handler):
+        timer = PhaseTimer()
+        token = request_timer.set(timer)
+        start = time.perf_counter()
+        status = 500
+        try:
+            if (
+                yapp.allow_profiling
+                and not _profiling
+                and PROFILE_HEADER in request.headers
+            ):
+                response = await _profiled(request, handler)
+            else:
+                response = await handler(request)
+            status = response.status
+            if not response.prepared:
+                response.headers["Server-Timing"] = timer.server_timing(
+                    time.perf_counter() - start
+                )
+            return response
+        finally:
+            request_timer.reset(token)
+            if timing_logger.isEnabledFor(logging.INFO):
+                total = time.perf_counter() - start
+                phases = {k: round(v * 1000, 3) for k, (v, _) in timer.phases.items()}
+                record = {
+                    "route": _route_name(request),
+                    "status": status,
+                    "total_ms": round(total * 1000, 3),
+                    "phases_ms": phases,
+                }
+                timing_logger.info(json.dumps(record))
+
+    return timing
+
+
+def _labels(**labels):
+    def escape(value):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        return value.replace('"', '\\"')
+
+    return ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusText:
+    """
+    Accumulate metrics in the Prometheus text exposition format.
+
+    >>> text = PrometheusText()
+    >>> text.sample('up', 'gauge', 'Server is up.', [({}, 1)])
+    >>> print(text.render(), end='')
+    # HELP up Server is up.
+    # TYPE up gauge
+    up 1
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def sample(self, name, kind, help, samples):
+        """
+        Add a metric of `kind` with a list of (labels, value) samples.
+        """
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            labels = _labels(**labels)
+            labels = f"{{{labels}}}" if labels else ""
+            self.lines.append(f"{name}{labels} {_format_value(value)}")
+
+    def histogram(self, name, help, samples):
+        """
+        Add a histogram metric with a list of (labels, stats) samples where
+        stats is the result of :meth:`Histogram.stats`.
+        """
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, stats in samples:
+            for bound, count in stats["buckets"].items():
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _labels(**labels, le=le)
+                self.lines.append(f"{name}_bucket{{{bucket_labels}}} {count}")
+            labels = _labels(**labels)
+            labels = f"{{{labels}}}" if labels else ""
+            self.lines.append(f"{name}_sum{labels} {_format_value(stats['sum'])}")
+            self.lines.append(f"{name}_count{labels} {stats['count']}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def _cache_samples(text, name, help, stats, results=("hits", "misses", "evictions")):
+    text.sample(
+        f"yenot_{name}_total",
+        "counter",
+        help,
+        [({"result": k}, stats[k]) for k in results],
+    )
+
+
+def prometheus_text(yapp):
+    """
+    Return the statistics of this process in the Prometheus text format.
+    """
+    from . import sqlread
+    from . import sqlwrite
+    from . import respcache
+
+    text = PrometheusText()
+    routes = sorted(route_stats.items())
+
+    text.sample(
+        "yenot_requests_total",
+        "counter",
+        "Requests by route and response status.",
+        [
+            ({"route": name, "status": status}, n)
+            for name, stats in routes
+            for status, n in sorted(stats.responses.items())
+        ],
+    )
+    text.sample(
+        "yenot_requests_in_flight",
+        "gauge",
+        "Requests being handled by route.",
+        [({"route": name}, stats.in_flight) for name, stats in routes],
+    )
+    text.histogram(
+        "yenot_request_duration_seconds",
+        "Request handling time by route.",
+        [({"route": name}, stats.latency.stats()) for name, stats in routes],
+    )
+    text.sample(
+        "yenot_result_rows_total",
+        "counter",
+        "Table rows serialized by route.",
+        [({"route": name}, stats.rows) for name, stats in routes],
+    )
+    text.sample(
+        "yenot_result_bytes_total",
+        "counter",
+        "Bytes of serialized results by route before compression.",
+        [({"route": name}, stats.bytes) for name, stats in routes],
+    )
+
+    pools = sorted(yapp.pool_stats().items())
+    for key, help in [
+        ("size", "Open connections by pool."),
+        ("idle", "Idle connections by pool."),
+        ("max_size", "Maximum connections by pool."),
+    ]:
+        text.sample(
+            f"yenot_pool_{key}",
+            "gauge",
+            help,
+            [({"pool": name}, stats[key]) for name, stats in pools],
+        )
+    text.sample(
+        "yenot_pool_in_use",
+        "gauge",
+        "Connections acquired from each pool.",
+        [({"pool": name}, stats["size"] - stats["idle"]) for name, stats in pools],
+    )
+    text.histogram(
+        "yenot_pool_acquire_wait_seconds",
+        "Time waiting for a connection by pool.",
+        [({"pool": name}, stats["wait"]) for name, stats in pools if "wait" in stats],
+    )
+
+    _cache_samples(
+        text,
+        "statement_cache",
+        "Prepared statement cache lookups.",
+        sqlread.statement_cache_stats(),
+    )
+    _cache_samples(
+        text,
+        "schema_cache",
+        "Table schema cache lookups.",
+        sqlwrite.schema_cache_stats(),
+    )
+    _cache_samples(
+        text,
+        "response_cache",
+        "Response cache lookups and invalidated entries.",
+        respcache.response_cache.stats(),
+        ("hits", "misses", "evictions", "invalidations"),
+    )
+    text.sample(
+        "yenot_slow_queries_dropped_total",
+        "counter",
+        "Slow statements not recorded in the event log.",
+        [({}, yapp.slow_queries_dropped)],
+    )
+    eventlog = yapp.eventlog.stats()
+    text.sample(
+        "yenot_eventlog_entries_total",
+        "counter",
+        "Event log entries by outcome.",
+        [
+            ({"result": k}, eventlog[k])
+            for k in ("written", "failed", "dropped", "rejected")
+        ],
+    )
+    text.sample(
+        "yenot_eventlog_queued",
+        "gauge",
+        "Event log entries waiting to be written.",
+        [({}, eventlog["queued"])],
+    )
+    return text.render()
@@ -1,29 +1,199 @@
 import json
+import codecs
+import asyncio
+import datetime
+import logging
 import collections
-#import rtlib
-#from bottle import request
-#import psycopg2.extras as extras
+import rtlib
+from . import sqlread
 from . import sqlwrite
 
 
 class UserError(Exception):
+    # HTTP status of the error response
+    status = 403
+
     def __init__(self, key, msg):
         super(UserError, self).__init__(msg)
         self.key = key
 
 
-def write_event_entry(conn, ltype, ldescr, ldata):
+class InvalidPayload(UserError):
+    status = 400
+
+    def __init__(self, msg):
+        super(InvalidPayload, self).__init__("invalid-payload", msg)
+
+
+class InvalidParameter(UserError):
+    status = 400
+
+    def __init__(self, msg):
+        super(InvalidParameter, self).__init__("invalid-param", msg)
+
+
+class DeadlineExceeded(UserError):
+    def __init__(self, msg="The request did not finish within its deadline."):
+        super(DeadlineExceeded, self).__init__("deadline-exceeded", msg)
+
+
+async def write_event_entry(conn, ltype, ldescr, ldata):
     ins = """
 insert into yenotsys.eventlog (logtype, logtime, descr, logdata)
 values (%(lt)s, current_timestamp, %(ld)s, %(lj)s)
 returning id, logtype, logtime;"""
-    dumps = lambda x: json.dumps(x, cls=rtlib.DateTimeEncoder)
-    with conn.cursor(cursor_factory=extras.NamedTupleCursor) as cursor:
-        cursor.execute(
-            ins, {"lt": ltype, "ld": ldescr, "lj": extras.Json(ldata, dumps=dumps)}
+    params = {"lt": ltype, "ld": ldescr, "lj": rtlib.serialize(ldata)}
+    return await sqlread.sql_1row(conn, ins, params)
+
+
+logger = logging.getLogger(__name__)
+
+# entries held for the event log writer; more are dropped and counted
+EVENTLOG_QUEUE_SIZE = 10000
+# most entries inserted per batch and seconds to wait for a batch to fill
+EVENTLOG_BATCH_SIZE = 200
+EVENTLOG_FLUSH_INTERVAL = 0.25
+
+_EVENTLOG_COLUMNS = ["logtype", "logtime", "descr", "logdata"]
+
+# queued by EventLogWriter.stop to end the background task
+_EVENTLOG_STOP = object()
+
+
+class EventLogWriter:
+    """
+    Write event log entries in batches from a background task.  The
+    :meth:`write` method only queues the entry so request handlers never
+    wait on the database for logging.  Entries are inserted with a binary
+    COPY every EVENTLOG_FLUSH_INTERVAL seconds or when EVENTLOG_BATCH_SIZE
+    are waiting.
+
+    :param dbconn: a callable returning an async context manager which
+        yields a database connection
+    """
+
+    def __init__(
+        self,
+        dbconn,
+        batch_size=EVENTLOG_BATCH_SIZE,
+        interval=EVENTLOG_FLUSH_INTERVAL,
+        maxsize=EVENTLOG_QUEUE_SIZE,
+    ):
+        self.dbconn = dbconn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = asyncio.Queue(maxsize)
+        self.counters = collections.Counter()
+        self._batch_ready = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def write(self, ltype, ldescr, ldata):
+        """
+        Queue an event log entry and return True or return False if the
+        queue is full or the data cannot be serialized.
+        """
+        logtime = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            # serialized now so that one bad entry cannot fail a whole batch
+            logdata = rtlib.serialize(ldata)
+        except (TypeError, ValueError) as e:
+            self.counters["rejected"] += 1
+            logger.warning(f"event log entry {ltype} not serializable: {e}")
+            return False
+        try:
+            self.queue.put_nowait((ltype, logtime, ldescr, logdata))
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            return False
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+        return True
+
+    def start(self):
+        if self._task == None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task after it wrote the entries queued before
+        and write those still queued.
+        """
+        if self._task != None:
+            # the task drains the queue up to the marker rather than being
+            # cancelled in the middle of a batch
+            await self.queue.put(_EVENTLOG_STOP)
+            self._batch_ready.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        while not self.queue.empty():
+            await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            entry = await self.queue.get()
+            if entry is _EVENTLOG_STOP:
+                break
+            if self.queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush([entry])
+
+    async def flush(self, batch=None):
+        """
+        Insert up to batch_size queued entries (after those in `batch`).
+        """
+        batch = [] if batch == None else batch
+        while len(batch) < self.batch_size and not self.queue.empty():
+            entry = self.queue.get_nowait()
+            if entry is _EVENTLOG_STOP:
+                self._stopping = True
+                break
+            batch.append(entry)
+        self._batch_ready.clear()
+        if len(batch) == 0:
+            return
+        try:
+            async with self.dbconn() as conn:
+                await self._insert(conn, batch)
+            self.counters["written"] += len(batch)
+        except Exception as e:
+            # logging must not take the server down with the database
+            self.counters["failed"] += len(batch)
+            logger.warning(f"{len(batch)} event log entries not written: {e}")
+
+    async def _insert(self, conn, batch):
+        types = await sqlwrite.WriteChunk(conn).table_column_types(
+            "yenotsys", "eventlog"
         )
-        row = list(cursor.fetchall())[0]
-    return row.id, row.logtype, row.logtime
+        naive = types.get("logtime", None) == "timestamp without time zone"
+        records = [
+            (
+                ltype,
+                logtime.astimezone().replace(tzinfo=None) if naive else logtime,
+                ldescr,
+                logdata,
+            )
+            for ltype, logtime, ldescr, logdata in batch
+        ]
+        await conn.copy_records_to_table(
+            "eventlog",
+            schema_name="yenotsys",
+            columns=_EVENTLOG_COLUMNS,
+            records=records,
+        )
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.counters["written"],
+            "failed": self.counters["failed"],
+            "dropped": self.counters["dropped"],
+            "rejected": self.counters["rejected"],
+        }
 
 
 def tab2_columns_transform(columns, insert=None, remove=None, column_map=None):
@@ -116,12 +286,18 @@ def tab2_rows_default(columns, indices, default):
 # rtlib server incoming utils
 
 
-def table_from_tab2(
+async def table_from_tab2(
     name, required=None, amendments=None, options=None, allow_extra=False
 ):
+    from . import plugins
+
+    request = plugins.current_request.get()
+    post = await request.post()
+    if name not in post:
+        raise UserError("invalid-collection", f'Post file "{name}" is missing.')
     try:
         return InboundTable.from_file(
-            request.files[name].file,
+            post[name].file,
             encoding="utf8",
             required=required,
             amendments=amendments,
@@ -135,6 +311,236 @@ def table_from_tab2(
         )
 
 
+async def table_stream_from_tab3(
+    name,
+    required=None,
+    amendments=None,
+    options=None,
+    allow_extra=False,
+    batch_rows=None,
+):
+    """
+    Return an :class:`InboundTableStream` reading the post file `name` from
+    the multipart request body as it arrives.  The fields are validated
+    before any row is read.  Parts before `name` are skipped so this must be
+    the last post data read by the handler.
+    """
+    from . import plugins
+
+    request = plugins.current_request.get()
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part == None:
+            raise UserError("invalid-collection", f'Post file "{name}" is missing.')
+        if part.name == name:
+            break
+        await part.release()
+
+    async def chunks():
+        while True:
+            chunk = await part.read_chunk(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    try:
+        stream = await InboundTableStream.open(
+            chunks(),
+            encoding="utf8",
+            required=required,
+            amendments=amendments,
+            options=options,
+            allow_extra=allow_extra,
+            batch_rows=batch_rows,
+        )
+    except RuntimeError as e:
+        raise UserError(
+            "invalid-collection",
+            f'Post file "{name}" contains incorrect data.  {str(e)}',
+        )
+    # errors in the rows are reported by batches() like those in the header
+    stream.name = name
+    return stream
+
+
+def _validate_fields(fields, required, amendments, options, allow_extra):
+    """
+    Check the fields of an inbound table and return the fields of the
+    DataRow including amendments.
+    """
+    clfields = list(fields)
+    allowed = set(options) if options != None else set()
+    if required == None:
+        required = []
+    if required != None:
+        allowed = allowed.union(required)
+    if amendments != None:
+        allowed = allowed.union(amendments)
+
+    if not allow_extra and not set(fields).issubset(allowed):
+        raise RuntimeError(
+            f"Extra fields given:  {' '.join(set(fields).difference(allowed))}"
+        )
+    if not set(required).issubset(fields):
+        raise RuntimeError(
+            "Required fields not given:  {}".format(
+                " ".join(set(required).difference(fields))
+            )
+        )
+    if amendments != None:
+        clfields += set(amendments).difference(fields)
+    return clfields
+
+
+# bytes per read of streamed post files and rows per yielded batch
+STREAM_READ_SIZE = 64 * 1024
+STREAM_BATCH_ROWS = 1000
+# characters of a single tab3 element (keys, fields or a row) held while it
+# arrives; larger or unterminated elements are refused
+STREAM_MAX_ELEMENT_SIZE = 16 * 1024 * 1024
+
+_WHITESPACE = " \t\n\r"
+
+
+class Tab3Reader:
+    """
+    Incrementally parse the tab3 payload ``[keys, fields, rows]`` from an
+    async iterator of byte chunks.  Each element is decoded with
+    json.JSONDecoder.raw_decode once its text has arrived so only one chunk
+    and one batch of rows are held at a time.  An element longer than
+    `max_element` characters raises :class:`InvalidPayload`.
+    """
+
+    def __init__(self, chunks, encoding="utf8", max_element=None):
+        self._chunks = chunks.__aiter__()
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        # text read but not yet joined to the buffer
+        self._pending = []
+        self._pending_size = 0
+        self._eof = False
+        if max_element == None:
+            max_element = STREAM_MAX_ELEMENT_SIZE
+        self.max_element = max_element
+
+    def _unread_size(self):
+        return len(self._buffer) - self._pos + self._pending_size
+
+    async def _read(self):
+        if self._eof:
+            raise RuntimeError("unexpected end of tab3 data")
+        if self._unread_size() > self.max_element:
+            raise InvalidPayload(
+                f"A tab3 element exceeds {self.max_element} characters."
+            )
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            chunk = b""
+        try:
+            text = self._decoder.decode(chunk, final=self._eof)
+        except UnicodeDecodeError as e:
+            raise RuntimeError(f"tab3 data is not valid text:  {e}")
+        self._pending.append(text)
+        self._pending_size += len(text)
+
+    def _join(self):
+        # Values are decoded in place from _pos; the buffer is only rebuilt
+        # (dropping the consumed text) when read text is appended to it.
+        if len(self._pending) == 0:
+            return
+        self._buffer = "".join([self._buffer[self._pos :]] + self._pending)
+        self._pos = 0
+        self._pending = []
+        self._pending_size = 0
+
+    async def _fill(self):
+        await self._read()
+        self._join()
+
+    async def _skip_whitespace(self):
+        while True:
+            buffer = self._buffer
+            while self._pos < len(buffer) and buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(buffer):
+                return buffer[self._pos]
+            await self._fill()
+
+    async def _expect(self, *punctuation):
+        char = await self._skip_whitespace()
+        if char not in punctuation:
+            raise RuntimeError(f"expected {' or '.join(punctuation)} in tab3 data")
+        self._pos += 1
+        return char
+
+    async def _value(self):
+        await self._skip_whitespace()
+        attempted = 0
+        while True:
+            # Decoding is retried once the unread text doubled so that an
+            # element arriving in many chunks is not decoded over and over.
+            if self._eof or self._unread_size() >= 2 * attempted:
+                self._join()
+                try:
+                    value, end = self._json.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    # Incomplete; the elements read here are arrays and
+                    # objects so a successful decode is never a truncated
+                    # value.
+                    if self._eof:
+                        raise RuntimeError("invalid JSON in tab3 data")
+                    attempted = self._unread_size()
+                else:
+                    self._pos = end
+                    return value
+            await self._read()
+
+    async def header(self):
+        """
+        Return the keys and fields of the payload.
+        """
+        await self._expect("[")
+        keys = await self._value()
+        await self._expect(",")
+        fields = await self._value()
+        await self._expect(",")
+        if not isinstance(keys, dict) or not isinstance(fields, list):
+            raise RuntimeError("tab3 data must start with keys and fields")
+        return keys, fields
+
+    async def rows(self):
+        """
+        Yield the rows of the payload as lists after :meth:`header`.
+        """
+        await self._expect("[")
+        if await self._skip_whitespace() == "]":
+            self._pos += 1
+        else:
+            while True:
+                yield await self._value()
+                if await self._expect(",", "]") == "]":
+                    break
+        await self._expect("]")
+        if not await self._at_end():
+            raise RuntimeError("trailing data after tab3 payload")
+
+    async def _at_end(self):
+        while True:
+            buffer = self._buffer
+            while self._pos < len(buffer) and buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(buffer):
+                return False
+            if self._eof:
+                return True
+            await self._fill()
+
+
 class InboundTable:
     def __init__(self, columns, rows):
         self.rows = rows[:]
@@ -152,27 +558,7 @@ class InboundTable:
     ):
         payload = json.loads(file.read().decode(encoding))
         keys, fields, rows = payload
-        clfields = list(fields)
-        allowed = set(options) if options != None else set()
-        if required == None:
-            required = []
-        if required != None:
-            allowed = allowed.union(required)
-        if amendments != None:
-            allowed = allowed.union(amendments)
-
-        if not allow_extra and not set(fields).issubset(allowed):
-            raise RuntimeError(
-                f"Extra fields given:  {' '.join(set(fields).difference(allowed))}"
-            )
-        if not set(required).issubset(fields):
-            raise RuntimeError(
-                "Required fields not given:  {}".format(
-                    " ".join(set(required).difference(fields))
-                )
-            )
-        if amendments != None:
-            clfields += set(amendments).difference(fields)
+        clfields = _validate_fields(fields, required, amendments, options, allow_extra)
 
         dr = rtlib.fixedrecord("DataRow", clfields)
         rows = [dr(**dict(zip(fields, r))) for r in rows]
@@ -183,6 +569,11 @@ class InboundTable:
         return self
 
     def as_cte(self, conn, cte, columns=None, column_types=None):
+        """
+        Return the SQL text of a CTE named `cte` with the rows as literals
+        cast to the types in `column_types`.  The connection is not used; it
+        remains for compatibility.
+        """
         if not columns:
             columns = self.DataRow.__slots__
 
@@ -191,13 +582,78 @@ class InboundTable:
     values/*REPRESENTED*/
 )"""
 
-        with conn.cursor() as cursor:
-            mogrifications = sqlwrite.mogrify_values(
-                cursor, self.rows, columns, column_types
-            )
+        mogrifications = sqlwrite.values_list(self.rows, columns, column_types)
 
         return (
             result_template.replace("/*REPRESENTED*/", mogrifications)
             .replace("/*COLUMNS*/", ", ".join(columns))
             .replace("/*NAME*/", cte)
         )
+
+
+class InboundTableStream:
+    """
+    An inbound table whose rows are read in batches as the upload arrives.
+    The columns, DataRow and deleted_keys match :class:`InboundTable`; the
+    rows are consumed once through :meth:`batches` (for instance by
+    sqlwrite.WriteChunk.insert_stream).
+    """
+
+    def __init__(self, reader, fields, clfields, batch_rows):
+        self._reader = reader
+        self._fields = fields
+        self.columns = [(c, None) for c in clfields]
+        self.DataRow = rtlib.fixedrecord("DataRow", clfields)
+        self.batch_rows = batch_rows
+        # post file name; when set, invalid rows raise UserError
+        self.name = None
+
+    @classmethod
+    async def open(
+        cls,
+        chunks,
+        encoding="utf8",
+        required=None,
+        amendments=None,
+        options=None,
+        allow_extra=False,
+        batch_rows=None,
+    ):
+        reader = Tab3Reader(chunks, encoding)
+        keys, fields = await reader.header()
+        clfields = _validate_fields(fields, required, amendments, options, allow_extra)
+        if batch_rows == None:
+            batch_rows = STREAM_BATCH_ROWS
+
+        self = cls(reader, fields, clfields, batch_rows)
+        self.deleted_keys = keys.get("deleted", [])
+        return self
+
+    async def batches(self):
+        """
+        Yield lists of DataRow instances of at most batch_rows rows.
+        """
+        try:
+            async for batch in self._batches():
+                yield batch
+        except RuntimeError as e:
+            if self.name == None:
+                raise
+            raise UserError(
+                "invalid-collection",
+                f'Post file "{self.name}" contains incorrect data.  {str(e)}',
+            )
+
+    async def _batches(self):
+        dr = self.DataRow
+        fields = self._fields
+        batch = []
+        async for r in self._reader.rows():
+            if not isinstance(r, list) or len(r) != len(fields):
+                raise RuntimeError("tab3 rows must match the fields")
+            batch.append(dr(**dict(zip(fields, r))))
+            if len(batch) >= self.batch_rows:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
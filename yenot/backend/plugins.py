@@ -1,7 +1,7 @@
 import os
 import sys
-import re
 import json
+import math
 import signal
 import asyncio
 import logging
@@ -9,43 +9,28 @@ import contextlib
 import urllib.parse
 import traceback
 import time
+import random
+import socket
+import hashlib
 import threading
-import queue
+import weakref
+import contextvars
 
 import aiohttp.web as web
 import asyncpg
 
 from . import misc
+from . import compression
+from . import respcache
+from . import sqlread
+from . import sqlwrite
+from . import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 
-class CancelQueue(queue.SimpleQueue):
-    def cancel(self):
-        self.put(("cancel", None))
-
-    def place_result(self, content):
-        self.put(("done", content))
-
-    def wait(self, timeout):
-        try:
-            x = self.get(timeout=timeout)
-        except queue.Empty:
-            # TODO: I'm not sure why one would use the wait function or what this exception means in this context
-            return
-
-        if x[0] == "cancel":
-            raise misc.UserError(
-                "cancel-request", "The request was canceled by the client."
-            )
-        elif x[0] == "done":
-            return x[1]
-        else:
-            raise RuntimeError("CancelQueue elements must be 2-tuples")
-
-
 async def create_connection(dburl):
     result = urllib.parse.urlsplit(dburl)
 
@@ -62,10 +47,10 @@ async def create_connection(dburl):
     return await asyncpg.connect(**kwargs)
 
 
-async def create_pool(dburl):
+async def create_pool(dburl, min_size=3, max_size=6, **kwargs):
     result = urllib.parse.urlsplit(dburl)
 
-    kwargs = {"database": result.path[1:]}
+    kwargs["database"] = result.path[1:]
     if result.hostname not in [None, ""]:
         kwargs["host"] = result.hostname
     if result.port != None:
@@ -75,7 +60,104 @@ async def create_pool(dburl):
     if result.password != None:
         kwargs["password"] = result.password
 
-    return await asyncpg.create_pool(min_size=3, max_size=6, **kwargs)
+    return await asyncpg.create_pool(min_size=min_size, max_size=max_size, **kwargs)
+
+
+# Each priority class has its own pool so that long reports and background
+# work cannot take every connection from interactive requests.
+POOL_CLASSES = {
+    "interactive": {"min_size": 3, "max_size": 6},
+    "report": {"min_size": 1, "max_size": 3},
+    "background": {"min_size": 0, "max_size": 2},
+}
+
+# Settings shared by all classes; max_lifetime is the age in seconds after
+# which a connection is closed on release rather than reused.
+POOL_SETTINGS = {
+    "max_queries": 50000,
+    "max_inactive_connection_lifetime": 300.0,
+    "max_lifetime": 3600.0,
+}
+
+# Slow statements waiting to be written to the event log; more are dropped.
+SLOW_QUERY_QUEUE_SIZE = 1000
+# fraction of slow statements recorded with their EXPLAIN plan
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("YENOT_SLOW_QUERY_EXPLAIN_RATE", 0.1))
+# record parameter values rather than their types
+SLOW_QUERY_PARAMS = os.getenv("YENOT_SLOW_QUERY_PARAMS", "") == "1"
+
+
+def redact_params(args):
+    """
+    Describe statement parameters without their values.
+
+    >>> redact_params([3, 'secret', None])
+    ['<int>', '<str>', None]
+    """
+    return [None if a is None else f"<{type(a).__name__}>" for a in args]
+
+
+def param_values(args):
+    """
+    Describe statement parameters by value with values not native to JSON
+    given as strings.
+
+    >>> param_values([3, b'ab', None, 1.5])
+    [3, "b'ab'", None, 1.5]
+    """
+    native = (str, int, float, bool)
+    return [a if a is None or type(a) in native else str(a) for a in args]
+
+
+def _slow_query_descr(entry):
+    return f"{entry['seconds']:.3f}s in {entry['route']}"
+
+
+# minimum seconds between restarts of a failing worker process
+WORKER_RESTART_DELAY = 1.0
+
+# pool size of each read replica
+REPLICA_POOL = {"min_size": 1, "max_size": 6}
+
+# seconds between replication lag checks and the lag above which a replica
+# is not used
+REPLICA_CHECK_INTERVAL = 5.0
+REPLICA_MAX_LAG = 30.0
+
+REPLICA_LAG_SELECT = """
+select case
+    when not pg_is_in_recovery() then 0
+    when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+    else extract(epoch from now() - pg_last_xact_replay_timestamp())
+end::float8"""
+
+_POOL_SETTING_TYPES = {
+    "min_size": int,
+    "max_size": int,
+    "max_queries": int,
+    "max_inactive_connection_lifetime": float,
+    "max_lifetime": float,
+}
+
+
+def pool_settings(priority, overrides=None):
+    """
+    Return the settings of the pool of a priority class (or "replica") from
+    the defaults, environment variables named like YENOT_POOL_REPORT_MAX_SIZE
+    and the `overrides` dictionary (in increasing precedence).
+    """
+    settings = dict(POOL_SETTINGS)
+    if priority == "replica":
+        settings.update(REPLICA_POOL)
+    else:
+        settings.update(POOL_CLASSES[priority])
+    for name, type_ in _POOL_SETTING_TYPES.items():
+        value = os.getenv(f"YENOT_POOL_{priority.upper()}_{name.upper()}", None)
+        if value != None:
+            settings[name] = type_(value)
+    if overrides != None:
+        settings.update(overrides.get(priority, {}))
+    return settings
 
 
 # to convert
@@ -85,27 +167,258 @@ async def create_pool(dburl):
 # - return YenotResult
 
 
+# the aiohttp request handled in the current task
+current_request = contextvars.ContextVar("yenot_request", default=None)
+
+
+@web.middleware
 async def yenot_handler(request, handler):
-    response = await handler(*args)
-    return ...
+    token = current_request.set(request)
+    try:
+        return await handler(request)
+    finally:
+        current_request.reset(token)
 
 
-class YenotApplication:
+CANCEL_TOKEN_HEADER = "X-Yenot-CancelToken"
+
+
+def cancel_middleware(yapp):
+    """
+    Return an aiohttp middleware running handlers of requests with a cancel
+    token in a child task which :meth:`YenotApplication.cancel_request` may
+    cancel.  Cancelling the task interrupts any asyncpg query in progress
+    which sends a cancel request to the server.
+    """
+
+    @web.middleware
+    async def cancellable(request, handler):
+        ctoken = request.headers.get(CANCEL_TOKEN_HEADER, None)
+        if ctoken == None:
+            return await handler(request)
+
+        # A client disconnect cancels this task and so the child task.
+        task = asyncio.ensure_future(handler(request))
+        yapp.register_task(ctoken, task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task not in yapp.canceled_tasks:
+                raise
+            keys = {"error-key": "cancel", "error-msg": "Client cancelled request"}
+            return web.json_response([keys], status=403)
+        finally:
+            yapp.unregister_task(ctoken, task)
+
+    return cancellable
+
+
+DEADLINE_HEADER = "X-Yenot-Deadline"
+
+
+def deadline_middleware(yapp):
+    """
+    Return an aiohttp middleware setting the statement deadline of requests
+    to routes registered with deadline=<seconds> (or timeout=<seconds>) and
+    of requests with a X-Yenot-Deadline header giving seconds from now.  The
+    earlier deadline wins.  Every sql_* call of the request is bounded by the
+    remaining time and fails with misc.DeadlineExceeded.
+    """
+
+    @web.middleware
+    async def deadline(request, handler):
+        options = compression.route_options(yapp, request)
+        budgets = [options.get("deadline", options.get("timeout", None))]
+        header = request.headers.get(DEADLINE_HEADER, None)
+        if header != None:
+            try:
+                budget = float(header)
+            except ValueError:
+                budget = None
+            # nan, inf and non-positive budgets would never or always expire
+            if budget == None or not math.isfinite(budget) or budget <= 0:
+                raise misc.InvalidParameter(
+                    f"{DEADLINE_HEADER} must be a positive number of seconds."
+                )
+            budgets.append(budget)
+        budgets = [b for b in budgets if b != None]
+        if len(budgets) == 0:
+            return await handler(request)
+
+        token = sqlread.statement_deadline.set(time.monotonic() + min(budgets))
+        try:
+            return await handler(request)
+        finally:
+            sqlread.statement_deadline.reset(token)
+
+    return deadline
+
+
+class Replica:
+    """
+    A read replica with its pool and last measured replication lag.
+    """
+
     def __init__(self, dburl):
+        self.dburl = dburl
+        # for logs and statistics without the credentials of the url
+        parts = urllib.parse.urlsplit(dburl)
+        port = f":{parts.port}" if parts.port != None else ""
+        self.name = f"replica {parts.hostname or ''}{port}{parts.path}"
+        self.pool = None
+        self.lag = None
+        self.healthy = True
+        # acquire wait times, apart from those of the primary pools
+        self.wait = metrics.Histogram()
+
+    def usable(self, max_lag):
+        return (
+            self.pool != None
+            and self.healthy
+            and self.lag != None
+            and self.lag <= max_lag
+        )
+
+    def busy(self):
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+
+def _duplicate_key_message(e):
+    # detail reads like:  Key (id)=(5) already exists.
+    _, found, value = (e.detail or "").partition(")=(")
+    value = value.rpartition(") already exists")[0]
+    if found and value:
+        return f'A duplicate key with value "{value}" was found.'
+    return "A duplicate key was found."
+
+
+def _error_keys(e):
+    """
+    Return the HTTP status, the error keys and whether to report the
+    exception to the event log.
+    """
+    pgerrors = asyncpg.exceptions
+    if isinstance(e, misc.UserError):
+        return e.status, {"error-key": e.key, "error-msg": str(e)}, False
+    elif isinstance(e, pgerrors.UniqueViolationError):
+        keys = {"error-key": "duplicate-key", "error-msg": _duplicate_key_message(e)}
+        return 403, keys, True
+    elif isinstance(e, pgerrors.NotNullViolationError):
+        msg = f'The value in field "{e.column_name}" must be non-empty and valid.'
+        return 403, {"error-key": "null-value", "error-msg": msg}, True
+    elif isinstance(e, pgerrors.IntegrityConstraintViolationError):
+        msg = f"An invalid value was passed to the database.\n\n{e}"
+        return 403, {"error-key": "data-integrity", "error-msg": msg}, True
+    elif isinstance(e, pgerrors.QueryCanceledError):
+        keys = {"error-key": "cancel", "error-msg": "Client cancelled request"}
+        return 403, keys, False
+    elif isinstance(e, pgerrors.SyntaxOrAccessError):
+        errdesc = e.message
+        if getattr(e, "position", None):
+            errdesc = f"{errdesc} (at character {e.position})"
+        msg = f"SQL Error:  {errdesc}"
+        return 500, {"error-key": "sql-syntax-error", "error-msg": msg}, True
+    else:
+        return 500, {"error-msg": str(e)}, True
+
+
+def _report_exception(yapp, request, status, keys):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    fsumm = [
+        (f.filename, f.lineno, f.name) for f in traceback.extract_tb(exc_traceback, 15)
+    ]
+    details = {
+        "exc_type": exc_type.__name__,
+        "exception": str(exc_value),
+        "session": request.headers.get("X-Yenot-SessionID", None),
+        "frames": list(reversed(fsumm)),
+    }
+    des = f"HTTP {status} - {keys.get('error-msg', None)}"
+    # queued; an error storm must not take connections from requests
+    yapp.eventlog.write("Yenot Server Error", des, details)
+
+
+def exception_middleware(yapp):
+    """
+    Return an aiohttp middleware answering exceptions raised by handlers with
+    the Yenot error JSON:  a list holding a dictionary of error-key and
+    error-msg.  Database errors are mapped by asyncpg exception class and
+    unexpected errors are queued for the event log.
+    """
+
+    @web.middleware
+    async def trap_exceptions(request, handler):
+        try:
+            return await handler(request)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            status, keys, report = _error_keys(e)
+            if status >= 500 and os.environ.get("YENOT_DEBUG", None):
+                traceback.print_exc()
+                sys.stderr.flush()
+            if report:
+                _report_exception(yapp, request, status, keys)
+            return web.json_response([keys], status=status)
+
+    return trap_exceptions
+
+
+class YenotApplication:
+    def __init__(self, dburl, pools=None, replicas=None):
         #self.routes = web.RouteTableDef()
 
-        self.app = web.Application()
+        self.app = web.Application(
+            middlewares=[
+                yenot_handler,
+                metrics.metrics_middleware,
+                metrics.timing_middleware(self),
+                exception_middleware(self),
+                cancel_middleware(self),
+                respcache.cache_middleware(self),
+                compression.compression_middleware(self),
+                deadline_middleware(self),
+            ]
+        )
         #self.app.add_routes(self.routes)
-
-        # create_pool(dburl)
-        self._pool = None
+        # keyword options given to the route decorators by route name
+        self.route_options = {}
+
+        # pools by priority class; see pool_settings for `pools`
+        self.pool_overrides = pools
+        self.pools = {}
+        self.pool_wait = {p: metrics.Histogram() for p in POOL_CLASSES}
+        self._pool_lock = asyncio.Lock()
+        self.pool_lifetimes = {}
+        self.replicas = [Replica(url) for url in (replicas or [])]
+        self.replica_max_lag = REPLICA_MAX_LAG
+        self._replica_turn = 0
+        self._replica_task = None
+        self._connection_births = weakref.WeakKeyDictionary()
+        self._listen_conn = None
+        # the listening socket of a worker process
+        self._sock = None
         self.dburl = dburl
-        self.dbconn_register = {}
+        # request handler tasks by cancel token
+        self.task_register = {}
+        self.canceled_tasks = weakref.WeakSet()
 
         self.sitevars = {}
+        self.eventlog = misc.EventLogWriter(
+            lambda: self.dbconn(priority="background")
+        )
+        self.slow_queries = asyncio.Queue(SLOW_QUERY_QUEUE_SIZE)
+        self.slow_queries_dropped = 0
+        self._slow_query_task = None
+        # honor the X-Yenot-Profile request header
+        self.allow_profiling = os.getenv("YENOT_ALLOW_PROFILING", "") == "1"
+        # register /api/metrics; it is not authenticated so it is only
+        # served where the network keeps it private
+        self.serve_metrics = os.getenv("YENOT_SERVE_METRICS", "") == "1"
 
     def _decorator(self, f, method, route, name, **kwargs):
         logger.info(f"adding {method} {route} -- {f}")
+        self.route_options[name] = kwargs
         route = self.app.router.add_route(method, route, f, name=name)
         logger.debug(dir(route))
 
@@ -139,68 +452,186 @@ class YenotApplication:
 
         return closure
 
-    # to become a method of app
-    @contextlib.contextmanager
-    def cancel_queue(self):
-        conn = CancelQueue()
-        ctoken = getattr(request, "cancel_token", None)
+    async def _create_pool(self, priority, dburl=None):
+        settings = pool_settings(priority, self.pool_overrides)
+        max_lifetime = settings.pop("max_lifetime")
+
+        async def init(conn):
+            self._connection_births[conn] = time.monotonic()
+
+        self.pool_lifetimes[priority] = max_lifetime
+        dburl = self.dburl if dburl == None else dburl
+        return await create_pool(dburl, init=init, **settings)
+
+    async def open_pools(self):
+        async with self._pool_lock:
+            for priority in POOL_CLASSES:
+                if priority not in self.pools:
+                    self.pools[priority] = await self._create_pool(priority)
+        if len(self.replicas) > 0 and self._replica_task == None:
+            self._replica_task = asyncio.create_task(self._watch_replicas())
+
+    async def close_pools(self):
+        if self._replica_task != None:
+            self._replica_task.cancel()
+            self._replica_task = None
+        async with self._pool_lock:
+            pools, self.pools = self.pools, {}
+        for replica in self.replicas:
+            if replica.pool != None:
+                pools[replica.name] = replica.pool
+                replica.pool = None
+        for pool in pools.values():
+            await pool.close()
+
+    async def _check_replica(self, replica):
         try:
-            if ctoken != None:
-                self.register_connection(ctoken, conn)
-            yield conn
-        finally:
-            if ctoken != None:
-                self.unregister_connection(ctoken, conn)
+            if replica.pool == None:
+                replica.pool = await self._create_pool("replica", replica.dburl)
+            async with replica.pool.acquire() as conn:
+                replica.lag = await conn.fetchval(
+                    REPLICA_LAG_SELECT, timeout=REPLICA_CHECK_INTERVAL
+                )
+            replica.healthy = True
+        except Exception as e:
+            # including InterfaceError of a closed pool; an unknown lag must
+            # not leave the replica in use
+            if replica.healthy:
+                logger.warning(f"{replica.name} unavailable: {e!r}")
+            replica.healthy = False
+
+    async def _watch_replicas(self):
+        while True:
+            checks = [self._check_replica(r) for r in self.replicas]
+            await asyncio.gather(*checks, return_exceptions=True)
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+    def _choose_replica(self):
+        """
+        Return the least busy usable replica (taking turns among equals) or
+        None.
+        """
+        usable = [r for r in self.replicas if r.usable(self.replica_max_lag)]
+        if len(usable) == 0:
+            return None
+        self._replica_turn = (self._replica_turn + 1) % len(usable)
+        usable = usable[self._replica_turn :] + usable[: self._replica_turn]
+        return min(usable, key=Replica.busy)
+
+    async def _get_pool(self, priority):
+        pool = self.pools.get(priority, None)
+        if pool == None:
+            # pools are opened at startup; this covers use before that
+            async with self._pool_lock:
+                if priority not in self.pools:
+                    self.pools[priority] = await self._create_pool(priority)
+                pool = self.pools[priority]
+        return pool
+
+    def _request_option(self, name, default):
+        request = current_request.get()
+        if request == None:
+            return default
+        return compression.route_options(self, request).get(name, default)
+
+    async def _acquire_replica(self):
+        replica = self._choose_replica()
+        if replica == None:
+            return None, None
+        try:
+            return replica, await replica.pool.acquire()
+        except Exception as e:
+            logger.warning(f"{replica.name} unavailable: {e!r}")
+            replica.healthy = False
+            return None, None
 
     @contextlib.asynccontextmanager
-    async def dbconn(self):
-        if not self._pool:
-            self._pool = await create_pool(self.dburl)
-        conn = await self._pool.acquire()
-        try:
-            yield conn
-        finally:
-            await self._pool.release(conn)
-
-    # @contextlib.contextmanager
-    # def dbconn(self):
-    #     conn = await self.pool.acquire()
-    #     ctoken = getattr(request, "cancel_token", None)
-    #     try:
-    #         if ctoken != None:
-    #             self.register_connection(ctoken, conn)
-    #         yield conn
-    #     finally:
-    #         if ctoken != None:
-    #             self.unregister_connection(ctoken, conn)
-    #         await self.pool.release(conn)
-
-    # to become a method of app
-    @contextlib.contextmanager
-    async def background_dbconn(self):
-        conn = await self.pool.acquire()
+    async def dbconn(self, priority=None, readonly=None):
+        """
+        Acquire a connection from the pool of the priority class
+        (interactive, report or background).  The default is the priority
+        route option of the current request or else interactive.
+
+        A readonly connection (by default per the readonly route option)
+        comes from a read replica within the lag limit if there is one and
+        otherwise from the primary.
+        """
+        if priority == None:
+            priority = self._request_option("priority", "interactive")
+        if readonly == None:
+            readonly = self._request_option("readonly", False)
+
+        start = time.monotonic()
+        replica, conn = None, None
+        if readonly and len(self.replicas) > 0:
+            replica, conn = await self._acquire_replica()
+        if conn != None:
+            pool, pool_class, wait = replica.pool, "replica", replica.wait
+        else:
+            pool, pool_class = await self._get_pool(priority), priority
+            wait = self.pool_wait[priority]
+            conn = await pool.acquire()
+        waited = time.monotonic() - start
+        wait.observe(waited)
+        metrics.add_phase("pool", waited)
         try:
             yield conn
         finally:
-            await self.pool.release(conn)
+            # a cancelled request must still reset the connection and return
+            # it to the pool
+            await asyncio.shield(self._release(pool_class, pool, conn))
+
+    async def _release(self, pool_class, pool, conn):
+        born = self._connection_births.get(sqlread._raw_connection(conn), None)
+        lifetime = self.pool_lifetimes[pool_class]
+        if born != None and time.monotonic() - born > lifetime:
+            # the pool replaces closed connections
+            await conn.close()
+        await pool.release(conn)
+
+    def background_dbconn(self):
+        return self.dbconn(priority="background")
+
+    def pool_stats(self):
+        """
+        Return the size, idle connections and acquire wait-time histogram of
+        each pool.
+        """
+        result = {}
+        for priority in POOL_CLASSES:
+            pool = self.pools.get(priority, None)
+            result[priority] = {
+                "size": pool.get_size() if pool != None else 0,
+                "idle": pool.get_idle_size() if pool != None else 0,
+                "max_size": pool.get_max_size() if pool != None else 0,
+                "wait": self.pool_wait[priority].stats(),
+            }
+        for replica in self.replicas:
+            pool = replica.pool
+            result[replica.name] = {
+                "size": pool.get_size() if pool != None else 0,
+                "idle": pool.get_idle_size() if pool != None else 0,
+                "max_size": pool.get_max_size() if pool != None else 0,
+                "lag": replica.lag,
+                "healthy": replica.healthy,
+                "wait": replica.wait.stats(),
+            }
+        return result
 
-    def register_connection(self, ctoken, conn):
-        if ctoken in self.dbconn_register:
-            self.dbconn_register[ctoken].append(conn)
-        else:
-            self.dbconn_register[ctoken] = [conn]
+    def register_task(self, ctoken, task):
+        self.task_register.setdefault(ctoken, []).append(task)
 
-    def unregister_connection(self, ctoken, conn):
-        if ctoken in self.dbconn_register:
-            self.dbconn_register[ctoken].remove(conn)
-            if len(self.dbconn_register[ctoken]) == 0:
-                del self.dbconn_register[ctoken]
+    def unregister_task(self, ctoken, task):
+        if ctoken in self.task_register:
+            self.task_register[ctoken].remove(task)
+            if len(self.task_register[ctoken]) == 0:
+                del self.task_register[ctoken]
 
     def cancel_request(self, cancel_token):
-        if cancel_token in self.dbconn_register:
-            connections = self.dbconn_register[cancel_token]
-            for conn in connections:
-                conn.cancel()
+        if cancel_token in self.task_register:
+            for task in self.task_register[cancel_token]:
+                self.canceled_tasks.add(task)
+                task.cancel()
         else:
             raise misc.UserError(
                 "invalid-param",
@@ -216,8 +647,64 @@ class YenotApplication:
         self.stop_thread = threading.Thread(target=make_it_stop)
         self.stop_thread.start()
 
+    def record_slow_query(self, sql, args, seconds, rows):
+        """
+        Queue a slow statement for the event log; installed as
+        sqlread.slow_query_handler.  This runs in the request and must not
+        wait.
+        """
+        request = current_request.get()
+        route = request.match_info.route.name if request != None else None
+        options = compression.route_options(self, request) if request != None else {}
+        if SLOW_QUERY_PARAMS and not options.get("redact", False):
+            params = param_values(args)
+        else:
+            params = redact_params(args)
+        entry = {
+            "sql_hash": hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16],
+            "sql": sql,
+            "params": params,
+            "seconds": round(seconds, 6),
+            "rows": rows,
+            "route": route,
+        }
+        if random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+            self.eventlog.write("Yenot Slow Query", _slow_query_descr(entry), entry)
+            return
+        try:
+            # the plan needs the actual values
+            self.slow_queries.put_nowait((entry, args))
+        except asyncio.QueueFull:
+            self.slow_queries_dropped += 1
+
+    async def _write_slow_queries(self):
+        # statements of this task are not themselves recorded
+        sqlread.slow_query_logging.set(False)
+        while True:
+            entry, args = await self.slow_queries.get()
+            try:
+                try:
+                    async with self.dbconn(priority="background") as conn:
+                        entry["plan"] = await self._explain(conn, entry["sql"], args)
+                except (OSError, asyncpg.PostgresError) as e:
+                    entry["plan"] = str(e)
+                descr = _slow_query_descr(entry)
+                self.eventlog.write("Yenot Slow Query", descr, entry)
+            except Exception:
+                # for instance a closed pool; this task must outlive it
+                logger.exception("could not record a slow statement")
+                self.slow_queries_dropped += 1
+
+    async def _explain(self, conn, sql, args):
+        try:
+            explain = f"explain (analyze off, format json) {sql}"
+            plan = await conn.fetchval(explain, *args)
+        except asyncpg.PostgresError as e:
+            return str(e)
+        return json.loads(plan) if isinstance(plan, str) else plan
+
     def request_content_title(self):
-        return request.route.name
+        return current_request.get().match_info.route.name
 
     def add_sitevars(self, sitevars):
         for c in sitevars:
@@ -227,13 +714,41 @@ class YenotApplication:
     async def _start(self):
         logger.info(f"server startup on http://{self.run_args['host']}:{self.run_args['port']}")
 
-        self.runner = web.AppRunner(self.app)
+        # cancel handlers (and their queries) when the client disconnects
+        self.runner = web.AppRunner(self.app, handler_cancellation=True)
         await self.runner.setup()
-        site = web.TCPSite(self.runner, self.run_args["host"], self.run_args["port"])
+        if self._sock != None:
+            # a worker of run_workers serving the socket inherited from the
+            # parent
+            site = web.SockSite(self.runner, self._sock)
+        else:
+            host, port = self.run_args["host"], self.run_args["port"]
+            site = web.TCPSite(self.runner, host, port)
         await site.start()
 
+        await self.open_pools()
+        self.eventlog.start()
+
+        if sqlread.SLOW_QUERY_THRESHOLD != None:
+            sqlread.slow_query_handler = self.record_slow_query
+            self._slow_query_task = asyncio.create_task(self._write_slow_queries())
+
+        try:
+            self._listen_conn = await create_connection(self.dburl)
+            await sqlwrite.listen_schema_changes(self._listen_conn)
+        except (OSError, asyncpg.PostgresError) as e:
+            # cached table schemas expire on their TTL instead
+            logger.warning(f"schema change notifications unavailable: {e}")
+
     async def _stop(self, sig):
+        if self._slow_query_task != None:
+            self._slow_query_task.cancel()
+        if self._listen_conn != None:
+            await self._listen_conn.close()
         await self.runner.cleanup()
+        # the final entries need the pools
+        await self.eventlog.stop()
+        await self.close_pools()
 
         asyncio.get_event_loop().stop()
 
@@ -250,20 +765,85 @@ class YenotApplication:
         loop.create_task(self._start())
         loop.run_forever()
 
+    def _spawn_worker(self, sock):
+        pid = os.fork()
+        if pid == 0:
+            # the worker; it opens its own pools in _start
+            status = 0
+            try:
+                for s in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(s, signal.SIG_DFL)
+                self._sock = sock
+                self.run()
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        return pid
+
+    def run_workers(self, count):
+        """
+        Serve with `count` forked worker processes sharing one listening
+        socket.  The parent restarts workers which exit unexpectedly and
+        passes SIGTERM and SIGINT on to them.  Call this before any event
+        loop or database connection exists in the process.
+        """
+        host, port = self.run_args["host"], self.run_args["port"]
+        logger.info(f"server startup of {count} workers on http://{host}:{port}")
+        sock = socket.create_server((host, port), reuse_port=False, backlog=1024)
+        sock.set_inheritable(True)
+
+        workers = {}
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        for s in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(s, stop)
+
+        for _ in range(count):
+            workers[self._spawn_worker(sock)] = time.monotonic()
+
+        while len(workers) > 0:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = workers.pop(pid, None)
+            if started == None or stopping:
+                continue
+            logger.warning(
+                f"worker {pid} exited with status {os.waitstatus_to_exitcode(status)}"
+            )
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                # do not spin on a worker failing at startup
+                time.sleep(WORKER_RESTART_DELAY)
+            if not stopping:
+                workers[self._spawn_worker(sock)] = time.monotonic()
+
+        sock.close()
+
 
 global_app = None
 
 
-def init_application(dburl):
+def init_application(dburl, pools=None, replicas=None):
     global global_app
 
-    app = YenotApplication(dburl)
+    app = YenotApplication(dburl, pools=pools, replicas=replicas)
 
     global_app = app
 
-    # app.install(RequestCancelTracker())
-    # app.install(ExceptionTrapper())
-
     # hook up the basic stuff
     import yenot.server  # noqa: F401
 
@@ -273,135 +853,3 @@ def init_application(dburl):
     }
 
     return app
-
-
-class RequestCancelTracker:
-    name = "yenot-cancel"
-    api = 2
-
-    def setup(self, app):
-        self.app = app
-
-    def apply(self, callback, route):
-        def wrapper(*args, **kwargs):
-            request.cancel_token = request.headers.get("X-Yenot-CancelToken", None)
-            return callback(*args, **kwargs)
-
-        return wrapper
-
-
-class ExceptionTrapper:
-    name = "yenot-exceptions"
-    api = 2
-
-    def setup(self, app):
-        # expect app to have dbconn
-        self.app = app
-
-    def report(self, e, myresponse, keys):
-        with self.app.dbconn() as conn:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            fsumm = [
-                (f.filename, f.lineno, f.name)
-                for f in traceback.extract_tb(exc_traceback, 15)
-            ]
-            details = {
-                "exc_type": exc_type.__name__,
-                "exception": str(exc_value),
-                "session": request.headers.get("X-Yenot-SessionID", None),
-                "frames": list(reversed(fsumm)),
-            }
-            des = f"HTTP {myresponse.status} - {keys.get('error-msg', None)}"
-            misc.write_event_entry(conn, "Yenot Server Error", des, details)
-            conn.commit()
-
-    def apply(self, callback, route):
-        def wrapper(*args, **kwargs):
-            try:
-                return callback(*args, **kwargs)
-            except psycopg2.IntegrityError as e:
-                if str(e).startswith("duplicate key value violates unique constraint"):
-                    match = re.search(
-                        r".*Key \([a-zA-Z0-9_]*\)=\((.*)\) already exists.", str(e)
-                    )
-                    msg = "A duplicate key was found."
-                    if match != None:
-                        msg = 'A duplicate key with value "{}" was found.'.format(
-                            match.group(1)
-                        )
-                    keys = {"error-key": "duplicate-key", "error-msg": msg}
-                elif str(e).startswith("null value in column "):
-                    match = re.match(
-                        r'null value in column "([a-zA-Z0-9_]*)" violates not-null constraint',
-                        str(e).split("\n")[0],
-                    )
-                    msg = 'The value in field "{}" must be non-empty and valid.'.format(
-                        match.group(1)
-                    )
-                    keys = {"error-key": "null-value", "error-msg": msg}
-                else:
-                    keys = {
-                        "error-key": "data-integrity",
-                        "error-msg": "An invalid value was passed to the database.\n\n{}".format(
-                            str(e)
-                        ),
-                    }
-                response.status = 403
-                self.report(e, response, keys)
-                return json.dumps([keys])
-            except psycopg2.ProgrammingError as e:
-                if bottle.DEBUG:
-                    traceback.print_exc()
-                    sys.stderr.flush()
-                try:
-                    prim = e.diag.message_primary
-                    lines = e.pgerror.split("\n")
-                    if (
-                        len(lines) >= 3
-                        and lines[1].startswith("LINE")
-                        and lines[2].find("^") >= 0
-                    ):
-                        c2 = lines[2].find("^")
-                        s2 = lines[1]
-                        sec = s2[:c2] + "##" + s2[c2:]
-                    elif len(lines) >= 2:
-                        sec = lines[1]
-                    else:
-                        sec = None
-                    if sec == None:
-                        errdesc = prim
-                    else:
-                        errdesc = f"{prim} ({sec})"
-                except Exception:
-                    errdesc = str(e)
-                keys = {
-                    "error-key": "sql-syntax-error",
-                    "error-msg": f"SQL Error:  {errdesc}",
-                }
-                response.status = 500
-                response.content_type = "application/json; charset=UTF-8"
-                self.report(e, response, keys)
-                return json.dumps([keys])
-            except psycopg2.extensions.QueryCanceledError:
-                keys = {"error-key": "cancel", "error-msg": "Client cancelled request"}
-                response.status = 403
-                return json.dumps([keys])
-            except misc.UserError as e:
-                keys = {"error-key": e.key, "error-msg": str(e)}
-                response.status = 403
-                response.content_type = "application/json; charset=UTF-8"
-                return json.dumps([keys])
-            except bottle.HTTPError:
-                raise
-            except Exception as e:
-                if bottle.DEBUG:
-                    traceback.print_exc()
-                    sys.stderr.flush()
-
-                keys = {"error-msg": str(e)}
-                response.status = 500
-                response.content_type = "application/json; charset=UTF-8"
-                self.report(e, response, keys)
-                return json.dumps([keys])
-
-        return wrapper
@@ -0,0 +1,274 @@
+"""
+Caching of complete responses of GET routes.
+
+Routes opt in with cache=<seconds> and may list cache_tags=[...].  Write
+routes list invalidates=[...] to drop the cached responses with any of those
+tags once they succeed; code may also call :func:`invalidate` directly.  The
+cache key is the route name, the path and sorted query parameters, the session
+and the Accept header so that clients only see responses they could have
+produced themselves, and the negotiated content coding since the cache sits
+outside of the compression middleware.  A hit is answered without running the handler or
+compressing again.
+
+Routes registered with singleflight=True coalesce concurrent GET requests
+with the same key into one execution of the handler; every waiting request
+receives a copy of its response (or its exception).
+"""
+import time
+import asyncio
+import collections
+import aiohttp.web as web
+from aiohttp import hdrs
+from . import compression
+
+# total bytes of response bodies held by the cache
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# responses larger than this are not cached
+CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+SESSION_HEADER = "X-Yenot-SessionID"
+
+CachedResponse = collections.namedtuple(
+    "CachedResponse", ["status", "body", "content_type", "charset", "headers"]
+)
+
+# headers of a cached response which are not replayed; these are set again
+# for each response
+_UNCACHED_HEADERS = {
+    hdrs.CONTENT_LENGTH.lower(),
+    hdrs.CONTENT_TYPE.lower(),
+    hdrs.DATE.lower(),
+    hdrs.TRANSFER_ENCODING.lower(),
+    "server-timing",
+}
+
+
+def request_key(yapp, request):
+    """
+    Return the key identifying equivalent requests for the same client.
+    """
+    route = request.match_info.route
+    query = tuple(sorted(request.query.items()))
+    return (
+        route.name,
+        tuple(sorted(request.match_info.items())),
+        query,
+        request.headers.get(SESSION_HEADER, None),
+        request.headers.get(hdrs.ACCEPT, None),
+        compression.negotiated_encoding(yapp, request),
+    )
+
+
+class ResponseCache:
+    """
+    An LRU mapping of request keys to CachedResponse tuples bounded by the
+    total size of the bodies.  Each entry has an expiration time and a set of
+    tags.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._tagged = collections.defaultdict(set)
+        self.counters = collections.Counter()
+        # incremented by each invalidation
+        self.generation = 0
+
+    def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry == None:
+            self.counters["misses"] += 1
+            return None
+        expires, _, response = entry
+        if expires <= time.monotonic():
+            self.discard(key)
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return response
+
+    def put(self, key, response, ttl, tags=()):
+        self.discard(key)
+        if len(response.body) > min(self.max_bytes, CACHE_MAX_ENTRY_BYTES):
+            return
+        self._entries[key] = (time.monotonic() + ttl, frozenset(tags), response)
+        self.size += len(response.body)
+        for tag in tags:
+            self._tagged[tag].add(key)
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry != None:
+            _, tags, response = entry
+            self.size -= len(response.body)
+            for tag in tags:
+                self._tagged[tag].discard(key)
+                if len(self._tagged[tag]) == 0:
+                    del self._tagged[tag]
+
+    def invalidate(self, tags):
+        self.generation += 1
+        for tag in tags:
+            for key in list(self._tagged.get(tag, ())):
+                self.discard(key)
+                self.counters["invalidations"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._tagged.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.counters["hits"],
+            "misses": self.counters["misses"],
+            "evictions": self.counters["evictions"],
+            "invalidations": self.counters["invalidations"],
+        }
+
+
+response_cache = ResponseCache()
+
+
+def invalidate(*tags):
+    """
+    Drop cached responses with any of the tags.
+    """
+    response_cache.invalidate(tags)
+
+
+def _as_response(cached):
+    response = web.Response(
+        status=cached.status,
+        body=cached.body,
+        content_type=cached.content_type,
+        charset=cached.charset,
+    )
+    for name, value in cached.headers:
+        response.headers.add(name, value)
+    return response
+
+
+def _snapshot(response):
+    """
+    Return a CachedResponse copy of a complete response of any status or
+    None for streams.
+    """
+    if type(response) is web.Response and isinstance(response.body, bytes):
+        headers = tuple(
+            (name, value)
+            for name, value in response.headers.items()
+            if name.lower() not in _UNCACHED_HEADERS
+        )
+        return CachedResponse(
+            response.status,
+            response.body,
+            response.content_type,
+            response.charset,
+            headers,
+        )
+    return None
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+# shared handler executions by request key
+_in_flight = {}
+
+
+async def _run_shared(handler, request):
+    response = await handler(request)
+    # copied now since the leader's response may be changed in place by the
+    # outer middlewares
+    return response, _snapshot(response)
+
+
+async def single_flight(key, request, handler):
+    """
+    Run the handler for the request unless an identical request is already
+    running and share its response, error responses and exceptions
+    included.  Streamed responses cannot be shared and the handler is run
+    again.
+    """
+    flight = _in_flight.get(key, None)
+    leader = flight == None
+    if leader:
+        flight = _Flight(asyncio.ensure_future(_run_shared(handler, request)))
+        _in_flight[key] = flight
+        flight.task.add_done_callback(
+            lambda _: _in_flight.pop(key) if _in_flight.get(key) is flight else None
+        )
+
+    flight.waiters += 1
+    try:
+        response, snapshot = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if not flight.task.done() and flight.waiters == 1:
+            # nobody else wants the result
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+
+    if leader:
+        return response
+    if snapshot != None:
+        return _as_response(snapshot)
+    return await handler(request)
+
+
+def cache_middleware(yapp):
+    """
+    Return an aiohttp middleware serving and storing the cached responses of
+    routes of the YenotApplication `yapp` registered with the cache option
+    and applying the invalidates and singleflight options.  It must be
+    installed outside of the compression middleware so that the compressed
+    bodies are cached.
+    """
+
+    @web.middleware
+    async def cache_response(request, handler):
+        options = compression.route_options(yapp, request)
+        ttl = options.get("cache", None)
+        invalidates = options.get("invalidates", None)
+
+        coalesce = options.get("singleflight", False) and request.method == "GET"
+
+        if (ttl == None and not coalesce) or request.method != "GET":
+            response = await handler(request)
+            if invalidates and response.status < 400:
+                response_cache.invalidate(invalidates)
+            return response
+
+        key = request_key(yapp, request)
+        if ttl != None:
+            cached = response_cache.get(key)
+            if cached != None:
+                return _as_response(cached)
+
+        generation = response_cache.generation
+        if coalesce:
+            response = await single_flight(key, request, handler)
+        else:
+            response = await handler(request)
+
+        # the data may predate an invalidation during the handler
+        if ttl != None and generation == response_cache.generation:
+            cached = _snapshot(response)
+            if cached != None and cached.status == 200:
+                response_cache.put(key, cached, ttl, options.get("cache_tags", ()))
+        return response
+
+    return cache_response
@@ -1,21 +1,95 @@
+import os
 import re
-#import psycopg2.extensions as psyext
-#import psycopg2.extras as extras
+import time
+import asyncio
+import functools
+import contextlib
+import contextvars
+import collections
+import asyncpg
+from . import metrics
 
+# rows fetched per round trip from a server-side cursor
+STREAM_PREFETCH = 2000
 
-def sql_rows(conn, select, params=None):
-    # The presence of non-none params in the call to execute causes psycopg2
-    # interpolation.   This may or may not be desirable in general.
+PLACEHOLDER_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+@functools.lru_cache(maxsize=1024)
+def _translate_placeholders(stmt):
+    names = []
+    numbers = {}
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        key = match.group(1) if match.group(1) != None else len(names)
+        if key not in numbers:
+            names.append(key)
+            numbers[key] = len(names)
+        return f"${numbers[key]}"
+
+    return PLACEHOLDER_RE.sub(replace, stmt), tuple(names)
+
+
+def to_asyncpg(stmt, params=None):
+    """
+    Translate an SQL statement with psycopg2 style placeholders to the
+    numbered placeholders of asyncpg and return the statement with the
+    positional argument list.  As with psycopg2 a statement without
+    parameters is not interpolated at all.
+
+    >>> to_asyncpg("select %(a)s, %(b)s, %(a)s", {"a": 1, "b": 2})
+    ('select $1, $2, $1', [1, 2])
+    >>> to_asyncpg("select %s, %s like 'x%%'", (3, 'y'))
+    ("select $1, $2 like 'x%'", [3, 'y'])
+    >>> to_asyncpg("select 'x%%'")
+    ("select 'x%%'", [])
+    """
     if params == None:
-        params = []
+        return stmt, []
+    sql, names = _translate_placeholders(stmt)
+    return sql, [params[n] for n in names]
+
+
+# time.monotonic() value by which statements of the current request must
+# finish; None for no deadline
+statement_deadline = contextvars.ContextVar("yenot_statement_deadline", default=None)
 
-    with conn.cursor(cursor_factory=extras.NamedTupleCursor) as cursor:
-        cursor.execute(select, params)
-        rows = list(cursor.fetchall())
+
+def _deadline_exceeded():
+    from . import misc
+
+    return misc.DeadlineExceeded()
+
+
+def remaining_time():
+    """
+    Return the seconds left before the deadline of the current request or
+    None if it has none.  Raise misc.DeadlineExceeded if the deadline passed.
+    """
+    deadline = statement_deadline.get()
+    if deadline == None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _deadline_exceeded()
+    return remaining
+
+
+async def sql_rows(conn, select, params=None):
+    # The presence of non-none params causes psycopg2 style placeholder
+    # interpolation.   This may or may not be desirable in general.
+    sql, args = to_asyncpg(select, params)
+    prepared, records = await _fetch(conn, sql, args)
+    start = time.perf_counter()
+    RowType = _row_type(tuple(a.name for a in prepared.get_attributes()))
+    rows = [RowType._make(r) for r in records]
+    metrics.add_phase("rows", time.perf_counter() - start)
     return rows
 
 
-def sql_1row(conn, select, params=None):
+async def sql_1row(conn, select, params=None):
     """
     Note that this function is designed to be always used with tuple unpacking
     for multiple columns and the single value is unpacked in the function.
@@ -23,66 +97,63 @@ def sql_1row(conn, select, params=None):
     and a tuple otherwise.  While this decision looks awkward at this level, it
     is convenient on the outside.
     """
-    # The presence of non-none params in the call to execute causes psycopg2
+    # The presence of non-none params causes psycopg2 style placeholder
     # interpolation.   This may or may not be desirable in general.
-    if params == None:
-        params = []
-    # use simple tuple cursor no matter what the connection cursor_factory is.
-    cursor = conn.cursor(cursor_factory=psyext.cursor)
-
-    cursor.execute(select, params)
-    results = list(cursor.fetchall())
+    sql, args = to_asyncpg(select, params)
+    prepared, results = await _fetch(conn, sql, args)
     if len(results) == 0:
-        row = (None,) * len(cursor.description)
+        row = (None,) * len(prepared.get_attributes())
     elif len(results) == 1:
-        row = results[0]
+        row = tuple(results[0])
     else:
         raise RuntimeError("Multiple row result in sql_1row")
 
-    cursor.close()
     # This is moderately ugly semantic decision here.  If you don't like it,
     # don't use this function :).
     return row[0] if len(row) == 1 else row
 
 
-def sql_1object(conn, select, params=None):
+async def sql_1object(conn, select, params=None):
     """
     Similarly to :meth:`sql_1row` this function executes an SQL select that is
     expected to return exactly one row.   It returns an object whose
     members are the row attributes named accordingly.
     """
-    # The presence of non-none params in the call to execute causes psycopg2
+    # The presence of non-none params causes psycopg2 style placeholder
     # interpolation.   This may or may not be desirable in general.
-    if params == None:
-        params = []
-
-    with conn.cursor(cursor_factory=extras.NamedTupleCursor) as cursor:
-        cursor.execute(select, params)
-        results = list(cursor.fetchall())
-        if len(results) == 0:
-            row = None
-        elif len(results) == 1:
-            row = results[0]
-        else:
-            raise RuntimeError("Multiple row result in sql_1row")
+    sql, args = to_asyncpg(select, params)
+    prepared, results = await _fetch(conn, sql, args)
+    if len(results) == 0:
+        row = None
+    elif len(results) == 1:
+        RowType = _row_type(tuple(a.name for a in prepared.get_attributes()))
+        row = RowType._make(results[0])
+    else:
+        raise RuntimeError("Multiple row result in sql_1row")
 
     return row
 
 
-def sql_void(conn, sql, params=None):
+async def sql_void(conn, sql, params=None):
     """
-    Execute an SQL statement.  You must call `conn.commit()` after this
-    function for the change to be committed.
+    Execute an SQL statement.  Without params the statement is sent
+    unprepared and may contain several commands.  Use a transaction block
+    of the connection to group changes.
     """
-    # The presence of non-none params in the call to execute causes psycopg2
-    # interpolation.   This may or may not be desirable in general.
     if params == None:
-        params = []
-    with conn.cursor() as cursor:
-        cursor.execute(sql, params)
+        start = time.perf_counter()
+        try:
+            await conn.execute(sql, timeout=remaining_time())
+        except asyncio.TimeoutError as e:
+            raise _deadline_exceeded() from e
+        finally:
+            metrics.add_phase("sql", time.perf_counter() - start)
+    else:
+        sql, args = to_asyncpg(sql, params)
+        await _fetch(conn, sql, args)
 
 
-def sql_tab2(conn, stmt, mogrify_params=None, column_map=None):
+async def sql_tab2(conn, stmt, mogrify_params=None, column_map=None):
     """
     This convenience function executes an SQL statement and returns a standard
     (columns, rows) tuple prepared to be returned from a Yenot REST end-point.
@@ -90,53 +161,333 @@ def sql_tab2(conn, stmt, mogrify_params=None, column_map=None):
     types are deduced from the SQL result types and the columns are refined by
     the column_map.
 
+    The deduced column types are cached by statement until the next schema
+    change notification.
+
     :param connection conn: a database connection object
     :param str stmt: SQL statement to be executed (likely with placeholders for substitution)
     :param dict/tuple mogrify_params: tuple or dictionary to substitute in stmt
     :param dict column_map: a dictionary of column names to rtlib column declaration dictionaries
     """
-    cursor = conn.cursor(cursor_factory=extras.NamedTupleCursor)
-    if mogrify_params != None:
-        cursor.execute(stmt, mogrify_params)
-    else:
-        cursor.execute(stmt)
-    columns, rows = _sql_tab2_cursor(cursor, column_map)
-    cursor.close()
+    sql, args = to_asyncpg(stmt, mogrify_params)
+    prepared, records = await _fetch(conn, sql, args)
+    columns, RowType = await _tab2_metadata(conn, prepared, sql, column_map)
+    start = time.perf_counter()
+    rows = [RowType._make(r) for r in records]
+    metrics.add_phase("rows", time.perf_counter() - start)
     return columns, rows
 
 
-def _sql_tab2_cursor(cursor, column_map=None):
+class LRUCache:
+    """
+    A bounded mapping which evicts the least recently used entry and counts
+    hits, misses and evictions.  Several caches may share one counters
+    object to report aggregate figures.
+    """
+
+    def __init__(self, maxsize, counters=None):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self.counters = collections.Counter() if counters == None else counters
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.counters["misses"] += 1
+            return default
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.counters["hits"],
+            "misses": self.counters["misses"],
+            "evictions": self.counters["evictions"],
+        }
+
+
+# prepared statements kept per database connection
+STATEMENT_CACHE_SIZE = 200
+
+# keyed by the underlying asyncpg connection which outlives pool proxies; the
+# prepared statements refer to their connection so the entry is dropped by a
+# termination listener rather than by a weak reference
+_statement_caches = {}
+_statement_counters = collections.Counter()
+
+
+def _drop_statement_cache(conn):
+    # asyncpg passes the pool proxy if the connection is acquired
+    _statement_caches.pop(_raw_connection(conn), None)
+
+
+def _raw_connection(conn):
+    # asyncpg pools hand out a proxy which is discarded on release
+    return getattr(conn, "_con", None) or conn
+
+
+async def _prepare(conn, sql, timeout=None):
+    """
+    Return a prepared statement for the sql text from the cache of this
+    connection.  The statements are named on the server and survive pool
+    release since the pool reset does not deallocate them.
+    """
+    raw = _raw_connection(conn)
+    cache = _statement_caches.get(raw, None)
+    if cache == None:
+        cache = LRUCache(STATEMENT_CACHE_SIZE, counters=_statement_counters)
+        _statement_caches[raw] = cache
+        # called when the pool retires the connection or it is lost
+        raw.add_termination_listener(_drop_statement_cache)
+    prepared = cache.get(sql)
+    if prepared == None:
+        prepared = await conn.prepare(sql, timeout=timeout)
+        cache.put(sql, prepared)
+    return prepared
+
+
+# Statements taking longer than this many seconds are passed to
+# slow_query_handler(sql, args, seconds, rows); None disables the check.
+SLOW_QUERY_THRESHOLD = (
+    float(os.environ["YENOT_SLOW_QUERY_MS"]) / 1000
+    if os.getenv("YENOT_SLOW_QUERY_MS", None)
+    else None
+)
+slow_query_handler = None
+# cleared in the task recording slow queries so that it does not recurse
+slow_query_logging = contextvars.ContextVar("yenot_slow_query_logging", default=True)
+
+
+async def _fetch(conn, sql, args):
+    start = time.perf_counter()
+    try:
+        prepared, records = await _fetch_prepared(conn, sql, args)
+    except asyncio.TimeoutError as e:
+        # asyncpg cancels the statement on the server when the timeout expires
+        raise _deadline_exceeded() from e
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.add_phase("sql", elapsed)
+
+    if (
+        SLOW_QUERY_THRESHOLD != None
+        and elapsed >= SLOW_QUERY_THRESHOLD
+        and slow_query_handler != None
+        and slow_query_logging.get()
+    ):
+        # the handler must only queue the record
+        slow_query_handler(sql, args, elapsed, len(records))
+    return prepared, records
+
+
+async def _fetch_prepared(conn, sql, args):
+    prepared = await _prepare(conn, sql, remaining_time())
+    try:
+        return prepared, await prepared.fetch(*args, timeout=remaining_time())
+    except asyncpg.exceptions.InvalidCachedStatementError:
+        # the statement went stale after a schema change; it can only be
+        # transparently re-prepared outside of a failed transaction
+        cache = _statement_caches.get(_raw_connection(conn), None)
+        if cache != None:
+            cache.discard(sql)
+        if conn.is_in_transaction():
+            raise
+        prepared = await _prepare(conn, sql, remaining_time())
+        return prepared, await prepared.fetch(*args, timeout=remaining_time())
+
+
+def statement_cache_stats():
+    """
+    Return aggregate hit, miss and eviction counts of the prepared statement
+    caches of all connections in this process.
+    """
+    caches = list(_statement_caches.values())
+    return {
+        "connections": len(caches),
+        "size": sum(len(c) for c in caches),
+        "maxsize": STATEMENT_CACHE_SIZE,
+        "hits": _statement_counters["hits"],
+        "misses": _statement_counters["misses"],
+        "evictions": _statement_counters["evictions"],
+    }
+
+
+@functools.lru_cache(maxsize=1024)
+def _row_type(names):
+    return collections.namedtuple("Row", names, rename=True)
+
+
+# PostgreSQL builtin type oids mapped to rtlib types
+PG_OID_RTLIB_TYPES = {
+    1082: "date",  # date
+    1083: "datetime",  # time; uncertain if this should be time-only
+    1266: "datetime",  # timetz
+    1114: "datetime",  # timestamp
+    1184: "datetime",  # timestamptz
+    20: "integer",  # int8
+    21: "integer",  # int2
+    23: "integer",  # int4
+    26: "integer",  # oid
+    700: "numeric",  # float4
+    701: "numeric",  # float8
+    790: "numeric",  # money
+    1700: "numeric",  # numeric
+    16: "boolean",  # bool
+}
+
+# the first user defined oid; lower oids are fixed builtin types
+PG_FIRST_NORMAL_OID = 16384
+
+BASE_TYPE_SELECT = """
+select t.oid, t.typbasetype
+from pg_catalog.pg_type t
+where t.oid = any($1::oid[]) and t.typtype = 'd'"""
+
+TAB2_METADATA_CACHE_SIZE = 512
+
+_tab2_metadata_cache = LRUCache(TAB2_METADATA_CACHE_SIZE)
+_domain_base_types = {}
+
+
+def invalidate_tab2_metadata():
+    """
+    Drop the cached result column types, for instance after DDL.
+    """
+    _tab2_metadata_cache.clear()
+    _domain_base_types.clear()
+
+
+async def _resolve_domains(conn, oids):
+    # domains of domains are followed down to the base type
+    while True:
+        pending = [
+            o
+            for o in oids
+            if o >= PG_FIRST_NORMAL_OID and o not in _domain_base_types
+        ]
+        if len(pending) == 0:
+            break
+        try:
+            records = await conn.fetch(
+                BASE_TYPE_SELECT, pending, timeout=remaining_time()
+            )
+        except asyncio.TimeoutError as e:
+            raise _deadline_exceeded() from e
+        found = dict(records)
+        for oid in pending:
+            _domain_base_types[oid] = found.get(oid, None)
+        oids = [b for b in found.values() if b != None]
+
+    def base(oid):
+        while _domain_base_types.get(oid, None) != None:
+            oid = _domain_base_types[oid]
+        return oid
+
+    return base
+
+
+async def _tab2_metadata(conn, prepared, sql, column_map=None):
     """
-    This function returns the rows from the (presumably psycopg2) cursor in the
-    format expected by Yenot clients.  Briefly, this format is a 2-tuple with
-    the first element a list of columns and the second element a list of rows
-    with values (no attribute names).  The index of the column in the first
-    element maps to the index of the value in each row.
+    Return the tab2 column list and a row type for the prepared statement.
+    Types are deduced from the type oids of the result columns with domains
+    resolved to their base type; arrays and other types are left untyped.
+    Note that asyncpg does not report a type modifier so max_length is not
+    deduced here.
     """
+    # the deduced types are cached by statement and result shape (the same
+    # sql may return other columns after DDL or under another search_path);
+    # the column_map is applied to fresh meta dictionaries on each call
+    attributes = prepared.get_attributes()
+    key = (sql, tuple((a.name, a.type.oid) for a in attributes))
+    cached = _tab2_metadata_cache.get(key)
+    if cached == None:
+        base = await _resolve_domains(conn, [a.type.oid for a in attributes])
+        names = tuple(a.name for a in attributes)
+        rtypes = tuple(
+            PG_OID_RTLIB_TYPES.get(base(a.type.oid), None) for a in attributes
+        )
+        RowType = collections.namedtuple("RowType", names, rename=True)
+        cached = (names, rtypes, RowType)
+        _tab2_metadata_cache.put(key, cached)
+
+    names, rtypes, RowType = cached
     if column_map == None:
         column_map = {}
-
-    rows = cursor.fetchall()
     columns = []
-    for pgcol in cursor.description:
-        rt = column_map.get(pgcol[0], {})
-        pgtype = pgcol.type_code
-        if "type" not in rt:
-            if pgtype in psyext.DATE.values:
-                rt["type"] = "date"
-            elif pgtype in psyext.TIME.values + psyext.PYDATETIME.values:
-                # Uncertain if this also contains a time-only value
-                rt["type"] = "datetime"
-            elif pgtype in psyext.INTEGER.values + psyext.LONGINTEGER.values:
-                rt["type"] = "integer"
-            elif pgtype in psyext.FLOAT.values + psyext.DECIMAL.values:
-                rt["type"] = "numeric"
-            elif pgtype in psyext.BOOLEAN.values:
-                rt["type"] = "boolean"
-        if pgtype in psyext.UNICODE.values and pgcol.internal_size > 0:
-            rt["max_length"] = pgcol.internal_size
-        columns.append((pgcol[0], rt))
-    return (columns, rows)
+    for name, rtype in zip(names, rtypes):
+        rt = dict(column_map.get(name, None) or {})
+        if "type" not in rt and rtype != None:
+            rt["type"] = rtype
+        columns.append((name, rt))
+    return columns, RowType
+
+
+async def _tab2_batches(cursor, RowType, prefetch):
+    while True:
+        start = time.perf_counter()
+        try:
+            records = await cursor.fetch(prefetch, timeout=remaining_time())
+        except asyncio.TimeoutError as e:
+            raise _deadline_exceeded() from e
+        finally:
+            metrics.add_phase("sql", time.perf_counter() - start)
+        if len(records) == 0:
+            break
+        yield [RowType._make(r) for r in records]
+
+
+@contextlib.asynccontextmanager
+async def sql_tab2_stream(
+    conn, stmt, mogrify_params=None, column_map=None, prefetch=STREAM_PREFETCH
+):
+    """
+    This is a streaming variant of :func:`sql_tab2` using a server-side
+    cursor.  It is an async context manager yielding a 2-tuple of the column
+    list and an async iterator of row batches with at most `prefetch` rows
+    each.  The cursor lives in a transaction for the duration of the block so
+    the rows must be consumed before it exits.
+
+    .. code-block:: python
+
+        async with api.sql_tab2_stream(conn, select, params) as (columns, batches):
+            results.tables["items", True] = columns, batches
+            return await results.json_stream(request)
+
+    :param connection conn: a database connection object
+    :param str stmt: SQL statement to be executed (likely with placeholders for substitution)
+    :param dict/tuple mogrify_params: tuple or dictionary to substitute in stmt
+    :param dict column_map: a dictionary of column names to rtlib column declaration dictionaries
+    :param int prefetch: number of rows fetched per round trip to the server
+    """
+    sql, args = to_asyncpg(stmt, mogrify_params)
+    async with conn.transaction():
+        try:
+            prepared = await _prepare(conn, sql, remaining_time())
+            columns, RowType = await _tab2_metadata(conn, prepared, sql, column_map)
+            cursor = await prepared.cursor(*args, timeout=remaining_time())
+        except asyncio.TimeoutError as e:
+            raise _deadline_exceeded() from e
+        yield columns, _tab2_batches(cursor, RowType, prefetch)
 
 
 def sanitize_fragment(text):
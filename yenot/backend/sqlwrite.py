@@ -1,6 +1,13 @@
 import re
+import json
+import time
+import decimal
+import zoneinfo
+import datetime
 import contextlib
-# from . import sqlread
+import collections
+import rtlib
+from . import sqlread
 
 
 PRIM_KEY_SELECT = """
@@ -19,11 +26,111 @@ where
 COL_TYPE_SELECT = """
 select tables.table_name, columns.column_name, columns.is_nullable, 
 	columns.data_type, columns.character_maximum_length, 
-	columns.numeric_precision, columns.numeric_precision_radix, columns.numeric_scale
+	columns.numeric_precision, columns.numeric_precision_radix, columns.numeric_scale,
+	columns.udt_schema, columns.udt_name
 from information_schema.tables
 join information_schema.columns on columns.table_name=tables.table_name
+	and columns.table_schema=tables.table_schema
 where tables.table_schema=%(sname)s and tables.table_name=%(tname)s and tables.table_type='BASE TABLE'"""
 
+# Seconds a cached table schema is trusted without a change notification;
+# this bounds staleness when the notification trigger is not installed.
+SCHEMA_CACHE_TTL = 300
+SCHEMA_NOTIFY_CHANNEL = "yenot_schema_changed"
+
+# The event trigger notifies the schema-qualified name of each changed table.
+# Other objects (domains, types, ...) notify an empty payload which clears
+# the whole cache.
+SCHEMA_NOTIFY_DDL = f"""
+create or replace function yenot_schema_changed_notify() returns event_trigger
+language plpgsql as $$
+declare
+    cmd record;
+begin
+    for cmd in select * from pg_event_trigger_ddl_commands() loop
+        if cmd.object_type in ('table', 'table column') then
+            perform pg_notify('{SCHEMA_NOTIFY_CHANNEL}',
+                    coalesce(cmd.schema_name || '.', '') ||
+                    (select relname from pg_class where oid=cmd.objid));
+        else
+            perform pg_notify('{SCHEMA_NOTIFY_CHANNEL}', '');
+        end if;
+    end loop;
+end;
+$$;
+
+drop event trigger if exists yenot_schema_changed;
+create event trigger yenot_schema_changed on ddl_command_end
+    execute procedure yenot_schema_changed_notify();
+"""
+
+TableSchema = collections.namedtuple("TableSchema", ["columns", "primary_key"])
+
+_schema_cache = sqlread.LRUCache(1024)
+
+
+async def table_schema(conn, sx, tx):
+    """
+    Return the TableSchema of the table sx.tx with the information_schema
+    rows of its columns and the list of its primary key columns.  Results
+    are cached for the process until a change notification or for
+    SCHEMA_CACHE_TTL seconds.
+    """
+    key = (sx, tx)
+    entry = _schema_cache.get(key)
+    if entry != None and entry[0] > time.monotonic():
+        return entry[1]
+
+    params = {"sname": sx, "tname": tx}
+    columns = await sqlread.sql_rows(conn, COL_TYPE_SELECT, params)
+    primary_key = await sqlread.sql_1row(conn, PRIM_KEY_SELECT, params)
+    schema = TableSchema(columns, primary_key)
+    _schema_cache.put(key, (time.monotonic() + SCHEMA_CACHE_TTL, schema))
+    return schema
+
+
+def invalidate_table_schema(name=None):
+    """
+    Drop the cached schema of the schema-qualified table `name` or of all
+    tables if `name` is None or empty.
+    """
+    if not name:
+        _schema_cache.clear()
+    else:
+        sx, _, tx = name.partition(".")
+        _schema_cache.discard((sx, tx))
+
+
+def schema_cache_stats():
+    return _schema_cache.stats()
+
+
+def install_schema_notify(conn, args=None):
+    """
+    Install the event trigger notifying schema changes to the servers.
+    Creating event triggers requires a superuser; pass this to
+    api.add_data_init.
+    """
+    return sqlread.sql_void(conn, SCHEMA_NOTIFY_DDL)
+
+
+def _schema_notified(conn, pid, channel, payload):
+    invalidate_table_schema(payload)
+    # result columns of any statement may have changed
+    sqlread.invalidate_tab2_metadata()
+
+
+async def listen_schema_changes(conn):
+    """
+    Invalidate cached table schemas and tab2 column types on notifications
+    from the trigger installed by :func:`install_schema_notify`.  `conn`
+    should be a dedicated connection held for the life of the server.
+    """
+    await conn.add_listener(SCHEMA_NOTIFY_CHANNEL, _schema_notified)
+    # changes made before listening are unknown
+    _schema_cache.clear()
+    sqlread.invalidate_tab2_metadata()
+
 
 class WriteChunk:
     def __init__(self, conn):
@@ -47,105 +154,373 @@ class WriteChunk:
 
         return sx, tx
 
-    def upsert_rows(self, tname, table):
+    async def upsert_rows(self, tname, table, chunk_size=None):
         sx, tx = WriteChunk._split_table_name(tname)
 
         if not hasattr(table, "deleted_keys"):
             table.deleted_keys = []
 
-        tosave = set(table.DataRow.__slots__)
-
-        cols = sqlread.sql_rows(self.conn, COL_TYPE_SELECT, {"sname": sx, "tname": tx})
-        coltypes = {}
-        for row in cols:
-            if row.column_name in tosave:
-                if row.data_type in ("character", "character varying", "text"):
-                    # no casting necessary
-                    pass
-                elif row.data_type == "numeric":
-                    coltypes[row.column_name] = "numeric({}, {})".format(
-                        row.numeric_precision, row.numeric_scale
-                    )
-                elif row.data_type in (
-                    "date",
-                    "boolean",
-                    "json",
-                    "integer",
-                    "smallint",
-                    "uuid",
-                ):
-                    # bit of a catch-all
-                    coltypes[row.column_name] = row.data_type
-                else:
-                    # untracked for now
-                    pass
+        schema = await table_schema(self.conn, sx, tx)
+        coltypes = text_casts(schema, table.DataRow.__slots__)
 
         mog = TableSaveMogrification()
-        mog.primary_key = sqlread.sql_1row(
-            self.conn, PRIM_KEY_SELECT, {"sname": sx, "tname": tx}
-        )
+        mog.primary_key = schema.primary_key
         mog.table = tname
         mog.column_types = coltypes
-        mog.persist(self.conn, table)
-
-    def delete_rows(self, tname, table):
+        if chunk_size != None:
+            mog.chunk_size = chunk_size
+        await mog.persist(self.conn, table)
+
+    async def table_column_types(self, sx, tx):
+        """
+        Return a dictionary of column names to information_schema data types
+        for the table.
+        """
+        schema = await table_schema(self.conn, sx, tx)
+        return {row.column_name: row.data_type for row in schema.columns}
+
+    async def delete_rows(self, tname, table):
+        """
+        Delete the rows of the table matching the primary key values of
+        `table`.  The keys are copied in binary to a temporary staging table
+        and deleted with a join.
+        """
         sx, tx = WriteChunk._split_table_name(tname)
 
-        keys = sqlread.sql_1row(self.conn, PRIM_KEY_SELECT, {"sname": sx, "tname": tx})
+        schema = await table_schema(self.conn, sx, tx)
+        keys = schema.primary_key
         if list(sorted(keys)) != list(sorted(table.DataRow.__slots__)):
             raise RuntimeError("primary key must be exactly represented")
 
+        columns = list(table.DataRow.__slots__)
+        coltypes = await self.table_column_types(sx, tx)
+        converters = await self._copy_converters(columns, coltypes)
+        if converters == None:
+            mog = TableSaveMogrification()
+            mog.table = tname
+            mog.column_types = text_casts(schema, columns)
+            sql = mog.upsert_statement(columns, columns, False, True)
+            rows = [r._as_tuple() for r in table.rows]
+            await self.conn.execute(sql, *mog._text_arrays(rows, columns))
+            return
+
+        stage = f"yenot_delete_{tx}"
+        c = ", ".join(f'"{col}"' for col in columns)
+        match = " and ".join(f'{tx}."{col}"={stage}."{col}"' for col in columns)
+
+        async with self.conn.transaction():
+            await self.conn.execute(
+                f"create temporary table {stage} as "
+                f"select {c} from {sx}.{tx} with no data"
+            )
+            await self.conn.copy_records_to_table(
+                stage,
+                columns=columns,
+                records=copy_records(table.rows, columns, converters),
+            )
+            await self.conn.execute(
+                f"delete from {sx}.{tx} using {stage} where {match}"
+            )
+            await self.conn.execute(f"drop table {stage}")
+
+    async def _copy_converters(self, columns, coltypes):
+        """
+        Return the converters of :func:`copy_converters` with the time zone
+        of the session for naive timestamps.
+        """
+        tzinfo = None
+        if "timestamp with time zone" in [coltypes.get(c, None) for c in columns]:
+            tzname = await self.conn.fetchval("select current_setting('TimeZone')")
+            tzinfo = _zone(tzname)
+            if tzinfo == None:
+                return None
+        return copy_converters(columns, coltypes, tzinfo)
+
+    async def _insert_text(self, tname, columns, rows):
+        """
+        Insert the rows sent as text arrays and cast by the server as a
+        fallback for column types without a binary COPY converter.
+        """
+        sx, tx = WriteChunk._split_table_name(tname)
+        schema = await table_schema(self.conn, sx, tx)
         mog = TableSaveMogrification()
-        values = mog.as_values(self.conn, table, table.DataRow.__slots__)
-        c = ", ".join(table.DataRow.__slots__)
+        mog.column_types = text_casts(schema, columns)
+        names = ", ".join(f'"{c}"' for c in columns)
+        sql = f"insert into {sx}.{tx} ({names}) {mog._unnest(columns, 1, 'u')}"
+        rows = [r._as_tuple() for r in rows]
+        for offset in range(0, len(rows), mog.chunk_size):
+            chunk = rows[offset : offset + mog.chunk_size]
+            await self.conn.execute(sql, *mog._text_arrays(chunk, columns))
+
+    async def insert_rows(self, tname, table):
+        """
+        Insert the rows of `table` with a binary COPY.
+        """
+        sx, tx = WriteChunk._split_table_name(tname)
 
-        delete_sql = """delete from {t} where ({columns}) in ({v})"""
-        with self.conn.cursor() as cursor:
-            cursor.execute(delete_sql.format(t=tname, columns=c, v=values))
+        columns = list(table.DataRow.__slots__)
+        coltypes = await self.table_column_types(sx, tx)
+        converters = await self._copy_converters(columns, coltypes)
+        if converters == None:
+            await self._insert_text(tname, columns, table.rows)
+            return
+        await self.conn.copy_records_to_table(
+            tx,
+            schema_name=sx,
+            columns=columns,
+            records=copy_records(table.rows, columns, converters),
+        )
 
-    def insert_rows(self, tname, table):
+    async def insert_stream(self, tname, table):
+        """
+        Insert the rows of a misc.InboundTableStream with a binary COPY as
+        the batches are read from the client.
+        """
         sx, tx = WriteChunk._split_table_name(tname)
 
-        insert_sql = """insert into {t} ({columns}) {v}"""
+        columns = list(table.DataRow.__slots__)
+        coltypes = await self.table_column_types(sx, tx)
+        converters = await self._copy_converters(columns, coltypes)
+        if converters == None:
+            async for batch in table.batches():
+                await self._insert_text(tname, columns, batch)
+            return
+
+        async def records():
+            async for batch in table.batches():
+                for record in copy_records(batch, columns, converters):
+                    yield record
+
+        await self.conn.copy_records_to_table(
+            tx, schema_name=sx, columns=columns, records=records()
+        )
 
-        mog = TableSaveMogrification()
-        values = mog.as_values(self.conn, table, table.DataRow.__slots__)
-        c = ", ".join(table.DataRow.__slots__)
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(insert_sql.format(t=tname, columns=c, v=values))
+def text_casts(schema, columns):
+    """
+    Return a dictionary of the columns to the SQL type which their values
+    sent as text are cast to.  Text columns need no cast.
+    """
+    wanted = set(columns)
+    coltypes = {}
+    for row in schema.columns:
+        if row.column_name not in wanted:
+            continue
+        if row.data_type in ("character", "character varying", "text"):
+            # no casting necessary
+            pass
+        elif row.data_type == "numeric" and row.numeric_precision == None:
+            coltypes[row.column_name] = "numeric"
+        elif row.data_type == "numeric":
+            coltypes[row.column_name] = "numeric({}, {})".format(
+                row.numeric_precision, row.numeric_scale
+            )
+        elif row.data_type in (
+            "date",
+            "boolean",
+            "json",
+            "integer",
+            "smallint",
+            "uuid",
+        ):
+            # bit of a catch-all
+            coltypes[row.column_name] = row.data_type
+        else:
+            # the values are sent as text so everything else is cast to the
+            # underlying type
+            coltypes[row.column_name] = '"{}"."{}"'.format(
+                row.udt_schema, row.udt_name
+            )
+    return coltypes
 
 
-@contextlib.contextmanager
-def writeblock(conn):
+@contextlib.asynccontextmanager
+async def writeblock(conn):
     yield WriteChunk(conn)
 
 
-def _mogrify_values(cursor, rows, row2dict, columns, types):
+def _parse_timestamp(v):
+    return datetime.datetime.fromisoformat(v) if isinstance(v, str) else v
+
+
+def _timestamptz_converter(tzinfo):
+    # naive values are read in the session time zone as SQL literals are
+    def convert(v):
+        v = _parse_timestamp(v)
+        if isinstance(v, datetime.datetime) and v.tzinfo == None:
+            v = v.replace(tzinfo=tzinfo)
+        return v
+
+    return convert
+
+
+def _parse_time(v):
+    return datetime.time.fromisoformat(v) if isinstance(v, str) else v
+
+
+def _to_int(v):
+    if isinstance(v, int):
+        return v
+    if isinstance(v, float) and not v.is_integer():
+        raise ValueError(f"{v} is not an integer")
+    return int(v)
+
+
+def _to_float(v):
+    return v if isinstance(v, float) else float(v)
+
+
+def _to_bool(v):
+    return v if isinstance(v, bool) else rtlib.parse_bool(v)
+
+
+def _to_decimal(v):
+    return v if isinstance(v, decimal.Decimal) else decimal.Decimal(str(v))
+
+
+def _to_json(v):
+    return v if isinstance(v, str) else json.dumps(v)
+
+
+def _zone(name):
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+        return None
+
+
+# Binary COPY needs python values of the column type, but values posted by
+# clients arrive as their JSON representation.  Tables with columns of other
+# types are written as text cast by the server; see copy_converters.
+COPY_CONVERTERS = {
+    "date": rtlib.parse_date,
+    "timestamp without time zone": _parse_timestamp,
+    "time without time zone": _parse_time,
+    "smallint": _to_int,
+    "integer": _to_int,
+    "bigint": _to_int,
+    "real": _to_float,
+    "double precision": _to_float,
+    "numeric": _to_decimal,
+    "boolean": _to_bool,
+    "json": _to_json,
+    "jsonb": _to_json,
+    "character": str,
+    "character varying": str,
+    "text": str,
+    "uuid": str,
+}
+
+
+def copy_converters(columns, coltypes, tzinfo=None):
+    """
+    Return the list of functions converting values of `columns` for a
+    binary COPY to columns with the information_schema data types in
+    `coltypes` or None if a column type has no converter.  `tzinfo` is the
+    time zone given to naive values of timestamp with time zone columns.
+
+    >>> copy_converters(['n'], {'n': 'integer'}) == [_to_int]
+    True
+    >>> copy_converters(['n', 'i'], {'n': 'integer', 'i': 'interval'}) == None
+    True
+    """
+    converters = []
+    for c in columns:
+        coltype = coltypes.get(c, None)
+        if coltype == "timestamp with time zone" and tzinfo != None:
+            converters.append(_timestamptz_converter(tzinfo))
+        elif coltype in COPY_CONVERTERS:
+            converters.append(COPY_CONVERTERS[coltype])
+        else:
+            return None
+    return converters
+
+
+def copy_records(rows, columns, converters):
+    """
+    Generate tuples of the row values in `columns` converted for a binary
+    COPY by the list from :func:`copy_converters`.
+    """
+    for row in rows:
+        yield tuple(
+            v if v is None else conv(v)
+            for conv, v in zip(converters, (getattr(row, c) for c in columns))
+        )
+
+
+def sql_literal(v):
+    """
+    Return an SQL literal of the value.  Values other than numbers and
+    booleans are quoted strings; cast them to their type.
+
+    >>> sql_literal("O'Neil"), sql_literal(None), sql_literal(3)
+    ("'O''Neil'", 'null', '3')
+    >>> sql_literal(datetime.date(2020, 3, 1))
+    "'2020-03-01'"
+    """
+    if v is None:
+        return "null"
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, (int, decimal.Decimal)) or (
+        isinstance(v, float) and v == v and abs(v) != float("inf")
+    ):
+        return str(v)
+    if isinstance(v, (datetime.date, datetime.time)):
+        v = v.isoformat()
+    # standard_conforming_strings leaves backslashes alone
+    return "'" + _as_text(v).replace("'", "''") + "'"
+
+
+def values_list(rows, columns, types=None):
+    """
+    Return the rows as the SQL text of the rows of a VALUES list.
+    """
     if isinstance(types, dict):
         types = [types.get(cname, None) for cname in columns]
     elif types == None:
         types = [None] * len(columns)
     assert len(types) == len(columns)
 
-    qualnames = [
-        f"%({cname})s::{t}" if t != None else f"%({cname})s"
-        for cname, t in zip(columns, types)
-    ]
-    fragment = f"({', '.join(qualnames)})"
-    mogrifications = [cursor.mogrify(fragment, row2dict(r)) for r in rows]
+    def value(v, t):
+        return sql_literal(v) if t == None else f"{sql_literal(v)}::{t}"
 
-    return ",\n\t".join([x.decode(cursor.connection.encoding) for x in mogrifications])
+    return ",\n\t".join(
+        "(" + ", ".join(value(getattr(r, c), t) for c, t in zip(columns, types)) + ")"
+        for r in rows
+    )
 
 
-def mogrify_values(cursor, rows, columns, types=None):
-    return _mogrify_values(cursor, rows, lambda r: r._as_dict(), columns, types)
+# rows sent per statement by TableSaveMogrification.persist
+PERSIST_CHUNK_SIZE = 5000
 
 
-def mogrify_values_anon(cursor, rows, columns, types=None):
-    return _mogrify_values(
-        cursor, rows, lambda r: dict(zip(columns, r)), columns, types
-    )
+def _pg_array_literal(values):
+    def element(v):
+        if v is None:
+            return "NULL"
+        if isinstance(v, (list, tuple)):
+            return _pg_array_literal(v)
+        text = _as_text(v).replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{text}"'
+
+    return "{" + ",".join(element(v) for v in values) + "}"
+
+
+def _as_text(v):
+    if isinstance(v, str):
+        return v
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, dict):
+        return json.dumps(v)
+    if isinstance(v, (list, tuple)):
+        return _pg_array_literal(v)
+    return str(v)
+
+
+def _as_json_text(v):
+    return v if isinstance(v, str) else json.dumps(v)
 
 
 class TableSaveMogrification:
@@ -154,140 +529,125 @@ class TableSaveMogrification:
 
         set transaction isolation level serializable;
         set constraints all deferred;
+
+    The rows are sent as one text array parameter per column and expanded
+    with unnest; column_types gives the cast applied to each column.
     """
 
     def __init__(self):
         self.table = None
         self.primary_key = None
         self.column_types = None
+        self.chunk_size = PERSIST_CHUNK_SIZE
+
+    def _cast(self, column):
+        t = (self.column_types or {}).get(column, None)
+        return f'"{column}"' if t == None else f'"{column}"::{t}'
+
+    def _text_arrays(self, rows, columns):
+        types = self.column_types or {}
+        converters = [
+            _as_json_text if types.get(c, None) in ("json", "jsonb") else _as_text
+            for c in columns
+        ]
+        arrays = [[] for _ in columns]
+        for row in rows:
+            for array, conv, v in zip(arrays, converters, row):
+                array.append(None if v is None else conv(v))
+        return arrays
+
+    def _unnest(self, columns, first_param, alias):
+        params = ", ".join(f"${first_param + i}::text[]" for i in range(len(columns)))
+        names = ", ".join(f'"{c}"' for c in columns)
+        casts = ", ".join(self._cast(c) for c in columns)
+        return f"select {casts} from unnest({params}) as {alias}({names})"
+
+    def upsert_statement(self, collist, pkey, with_rows=True, with_deletes=False):
+        """
+        Return the SQL deleting keys or upserting rows.  The parameters are
+        the text arrays of collist followed by the text arrays of pkey for
+        the deletes.  :meth:`persist` runs the deletes as a statement of
+        their own.
+        """
+        cols_no_pk = [c for c in collist if c not in pkey]
 
-    def as_values(self, conn, table, columns):
-        result_template = """\
-values/*REPRESENTED*/
-"""
+        colnames = ", ".join(f'"{c}"' for c in collist)
+        colnames_no_pk = ", ".join(f'"{c}"' for c in cols_no_pk)
+        pknames = ", ".join(f'"{c}"' for c in pkey)
+        colassign = ", ".join(f'"{c}"=excluded."{c}"' for c in cols_no_pk)
+
+        ctes = []
+        if with_deletes:
+            first = len(collist) + 1 if with_rows else 1
+            ctes.append(
+                f"""\
+deleted as (
+    delete from {self.table} where ({pknames}) in (
+        {self._unnest(pkey, first, "d")}
+    )
+)"""
+            )
 
-        with conn.cursor() as cursor:
-            mogrifications = mogrify_values(
-                cursor, table.rows, columns, self.column_types
+        if with_rows:
+            ctes.append(
+                f"""\
+staging as (
+    {self._unnest(collist, 1, "u")}
+)"""
+            )
+            if len(cols_no_pk) > 0:
+                conflict = f"do update set {colassign}"
+            else:
+                conflict = "do nothing"
+            if len(pkey) == 1 and len(cols_no_pk) > 0:
+                # rows without a primary key are inserted with its default;
+                # defaulting is not supported on composite primary key nor
+                # on a table of only the primary key (a null key there
+                # fails the not-null constraint)
+                keyed = f'where "{pkey[0]}" is not null'
+                ctes.append(
+                    f"""\
+defaulted as (
+    insert into {self.table} ({colnames_no_pk})
+    select {colnames_no_pk} from staging where "{pkey[0]}" is null
+)"""
+                )
+            else:
+                keyed = ""
+            ctes.append(
+                f"""\
+upserted as (
+    insert into {self.table} ({colnames})
+    select {colnames} from staging {keyed}
+    on conflict ({pknames}) {conflict}
+)"""
             )
 
-        return result_template.replace("/*REPRESENTED*/", mogrifications)
+        return "with " + ",\n".join(ctes) + "\nselect 1"
 
-    def persist(self, conn, table):
-        collist = table.DataRow.__slots__
+    async def persist(self, conn, table):
+        collist = list(table.DataRow.__slots__)
 
         if isinstance(self.primary_key, str):
             pkey = [self.primary_key]
         else:
-            pkey = self.primary_key
-
-        cols_no_pk = [c for c in collist if c not in pkey]
-
-        colnames = ", ".join(['"{0}"'.format(c) for c in collist])
-        colnames_no_pk = ", ".join(['"{0}"'.format(c) for c in cols_no_pk])
-        staging_no_pk = ", ".join(['staging."{0}"'.format(c) for c in cols_no_pk])
-        colassign = ", ".join(['"{0}"=staging."{0}"'.format(c) for c in cols_no_pk])
-
-        interpolations = {
-            "fqtn": self.table,
-            "tn": self.table.rsplit(".", 1)[-1],
-            "colnames": colnames,
-            "colassign": colassign,
-            "colnames_no_pk": colnames_no_pk,
-            "staging_no_pk": staging_no_pk,
-        }
-
-        m1 = ["{tn}.{pk}=staging.{pk}".format(pk=pk, **interpolations) for pk in pkey]
-        pkey_match = " and ".join(m1)
-        m1 = ["{tn}.{pk} is null".format(pk=pk, **interpolations) for pk in pkey]
-        pkey_null = " and ".join(m1)
-
-        interpolations["pkm"] = pkey_match
-        interpolations["pkn"] = pkey_null
-
-        insert = """
-with staging({colnames}) as (
-    values/*REPRESENTED*/
-)
-insert into {fqtn} ({colnames})
-(
-    select staging.*
-    from staging
-    left outer join {fqtn} on {pkm}
-    where {pkn}
-)""".format(
-            **interpolations
-        )
-
-        insert2 = """
-with staging({colnames}) as (
-    values/*REPRESENTED*/
-)
-insert into {fqtn} ({colnames_no_pk})
-(
-    select {staging_no_pk}
-    from staging
-    left outer join {fqtn} on {pkm}
-    where {pkn}
-)""".format(
-            **interpolations
-        )
-
-        update = """
-with staging({colnames}) as (
-    values/*REPRESENTED*/
-)
-update {fqtn} set {colassign} 
-from staging
-where {pkm}""".format(
-            **interpolations
-        )
-
-        delete = """
-with staging({pknames}) as (
-    values/*REPRESENTED*/
-)
-delete from {fqtn} where ({pknames}) in (select * from staging)""".format(
-            pknames=",".join(pkey), **interpolations
-        )
-
-        with conn.cursor() as cursor:
-            # Delete first since other rows may induce duplicates ... although
-            # this raises questions about whether this just moves problems
-            # around.  Hence we recommend "set constraints all deferred".
-            if len(table.deleted_keys) > 0:
-                mogrifications = mogrify_values_anon(
-                    cursor, table.deleted_keys, pkey, self.column_types
-                )
-                my_delete = delete.replace("/*REPRESENTED*/", mogrifications)
-                cursor.execute(my_delete, {"keys": tuple(table.deleted_keys)})
-
-            if len(pkey) == 1:
-                need_defaulting = lambda row: None in [getattr(row, p) for p in pkey]
-                rows1 = [row for row in table.rows if not need_defaulting(row)]
-                rows2 = [row for row in table.rows if need_defaulting(row)]
-            else:
-                # defaulting is not supported on composite primary key
-                rows1 = table.rows
-                rows2 = []
-            if len(rows1) > 0:
-                mogrifications = mogrify_values(
-                    cursor, rows1, collist, self.column_types
-                )
-
-                # TODO: consider using upsert
-                if len(cols_no_pk) > 0:
-                    # update
-                    my_update = update.replace("/*REPRESENTED*/", mogrifications)
-                    cursor.execute(my_update)
-                # insert
-                my_insert = insert.replace("/*REPRESENTED*/", mogrifications)
-                cursor.execute(my_insert)
-
-            if len(rows2) > 0:
-                mogrifications = mogrify_values(
-                    cursor, rows2, collist, self.column_types
-                )
-                # insert
-                my_insert = insert2.replace("/*REPRESENTED*/", mogrifications)
-                cursor.execute(my_insert)
+            pkey = list(self.primary_key)
+
+        rows = [r._as_tuple() for r in table.rows]
+        deleted = [list(k) for k in table.deleted_keys]
+        chunks = [
+            rows[offset : offset + self.chunk_size]
+            for offset in range(0, len(rows), self.chunk_size)
+        ]
+
+        # The deletes run first as a statement of their own; in the upsert
+        # statement they would share its snapshot and a deleted row could
+        # still conflict with a new row on any unique constraint.
+        async with conn.transaction():
+            if len(deleted) > 0:
+                sql = self.upsert_statement(collist, pkey, False, True)
+                await conn.execute(sql, *self._text_arrays(deleted, pkey))
+
+            for chunk in chunks:
+                sql = self.upsert_statement(collist, pkey, True, False)
+                await conn.execute(sql, *self._text_arrays(chunk, collist))
@@ -27,3 +27,17 @@ async def put_api_request_cancel(request):
     token = request.query.get("token")
     app.cancel_request(token)
     return api.Results().json_out()
+
+
+if app.serve_metrics:
+    # route names, pool and replica state are exposed without
+    # authentication; the route only exists when configured
+    @app.get("/api/metrics", name="api_metrics", skip=["yenot-auth"])
+    async def get_api_metrics(request):
+        import aiohttp.web as web
+        import yenot.backend.metrics as metrics
+
+        return web.Response(
+            body=metrics.prometheus_text(app).encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )